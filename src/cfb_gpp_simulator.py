@@ -1,27 +1,93 @@
 import csv
+import hashlib
 import json
+import importlib.util
 import math
 import os
+import queue
 import random
+import sys
 import time
+import warnings
+# BLAS reads its thread count from the environment once, when numpy loads it. main.py sets it before that
+blas_env_threads = None if "numpy" in sys.modules else os.environ.get("OMP_NUM_THREADS")
 import numpy as np
-import pulp as plp
 import multiprocessing as mp
-import pandas as pd
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
+import threading
 import statistics
 # import fuzzywuzzy
 import itertools
 import collections
 import re
-from scipy.stats import norm, kendalltau, multivariate_normal, gamma
+from execution_policy import blas_thread_vars, resolve_worker_threads
+from field_lineups import FieldLineups
+from payout_bands import PayoutBands
+from player_table import PlayerTable
 #import matplotlib.pyplot as plt
 #import seaborn as sns
 
+# read only slate arrays (plus a few scalar settings) that pool workers attach to once, keyed by name
+shared_arrays = {}
+shared_blocks = []
+
+
+def publish_shared_arrays(arrays):
+    # copy each array into its own shared memory block, returns the blocks (which the caller must close and unlink)
+    # and the (block name, shape, dtype) specs workers need to attach to them
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def attach_shared_arrays(specs, params):
+    # pool initializer, runs once per worker
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        # keep a reference to the block or the buffer behind the array goes away
+        shared_blocks.append(block)
+        shared_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    shared_arrays.update(params)
+
+
+blas_limits = []
+
+
+def limit_blas_threads(num_threads):
+    # cap the threads BLAS uses in this process. the environment variables only reach libraries loaded after
+    # this (like the ones in freshly spawned workers), threadpoolctl also reaches the ones already loaded
+    for var in blas_thread_vars:
+        os.environ[var] = str(num_threads)
+    if importlib.util.find_spec("threadpoolctl") is not None:
+        from threadpoolctl import threadpool_limits
+        blas_limits.append(threadpool_limits(limits=num_threads))
+
+
+def init_worker(specs, params, blas_threads, cpu_sets):
+    # pool initializer, runs once per worker. cpu_sets is a queue with one cpu set per worker, or None
+    if blas_threads:
+        limit_blas_threads(blas_threads)
+    if cpu_sets is not None:
+        try:
+            # pid 0 is the calling process, or the calling thread for thread workers
+            os.sched_setaffinity(0, cpu_sets.get_nowait())
+        except queue.Empty:
+            pass
+    if specs is not None:
+        attach_shared_arrays(specs, params)
+
 
 class CFB_GPP_Simulator:
     config = None
     player_dict = {}
-    field_lineups = {}
+    field_lineups = None
+    player_table = None
     stacks_dict = {}
     gen_lineup_list = []
     roster_construction = []
@@ -32,7 +98,7 @@ class CFB_GPP_Simulator:
     team_list = []
     num_iterations = None
     site = None
-    payout_structure = {}
+    payouts = None
     use_contest_data = False
     entry_fee = None
     use_lineup_input = None
@@ -43,6 +109,29 @@ class CFB_GPP_Simulator:
     max_pct_off_optimal = 0.4
     teams_dict = collections.defaultdict(list)  # Initialize teams_dict
     correlation_rules = {}
+    team_indices = {}
+    correlation_positions = ['QB', 'RB', 'WR']
+    position_codes = None
+    correlation_table = None
+    covariance_factors = {}
+    cache_dir = os.path.join(os.path.dirname(__file__), "../output/cache")
+    field_matrix = None
+    field_unique_index = None
+    lineup_counts = None
+    confidence_intervals = None
+    sim_batches = []
+    player_changes = {}
+    entries = None
+    contest_name = None
+    locked_fpts = None
+    sim_payouts = None
+    sim_payouts_filled = 0
+    slate_snapshot_version = 2
+    # the only settings the parsed slate depends on, the rest of config.json can change without a re-parse
+    slate_config_keys = ["projection_path", "player_path", "contest_structure_path", "default_qb_var",
+                         "default_skillpos_var"]
+    pool = None
+    pool_blocks = []
 
     def __init__(
             self,
@@ -51,42 +140,31 @@ class CFB_GPP_Simulator:
             num_iterations,
             use_contest_data,
             use_lineup_input,
+            execution_policy=None,
     ):
         self.site = site
         self.use_lineup_input = use_lineup_input
         self.load_config()
+        # execution policy settings passed on the command line win over config.json
+        if execution_policy:
+            self.config.update(execution_policy)
         self.load_rules()
+        self.print_execution_policy()
 
         projection_path = os.path.join(
             os.path.dirname(__file__),
             "../{}_data/{}".format(site, self.config["projection_path"]),
         )
-        self.load_projections(projection_path)
-
         player_path = os.path.join(
             os.path.dirname(__file__),
             "../{}_data/{}".format(site, self.config["player_path"]),
         )
-        self.load_player_ids(player_path)
-        self.load_team_stacks()
-
-        # ownership_path = os.path.join(
-        #    os.path.dirname(__file__),
-        #    "../{}_data/{}".format(site, self.config["ownership_path"]),
-        # )
-        # self.load_ownership(ownership_path)
-
-        # boom_bust_path = os.path.join(
-        #    os.path.dirname(__file__),
-        #    "../{}_data/{}".format(site, self.config["boom_bust_path"]),
-        # )
-        # self.load_boom_bust(boom_bust_path)
-
-        #       batting_order_path = os.path.join(
-        #           os.path.dirname(__file__),
-        #            "../{}_data/{}".format(site, self.config["batting_order_path"]),
-        #        )
-        #        self.load_batting_order(batting_order_path)
+        contest_path = None
+        if use_contest_data:
+            contest_path = os.path.join(
+                os.path.dirname(__file__),
+                "../{}_data/{}".format(site, self.config["contest_structure_path"]),
+            )
 
         if site == "dk":
             self.roster_construction = ['QB', 'RB', 'RB', 'WR', 'WR', 'WR', 'FLEX', 'S-FLEX']
@@ -97,26 +175,69 @@ class CFB_GPP_Simulator:
             self.salary = 60000
 
         self.use_contest_data = use_contest_data
+        # the parsed slate only depends on these files, so an unchanged slate is loaded from its snapshot
+        # instead of re-parsing everything and re-solving the optimal lineup
+        self.slate_files = [projection_path, player_path]
         if use_contest_data:
-            contest_path = os.path.join(
-                os.path.dirname(__file__),
-                "../{}_data/{}".format(site, self.config["contest_structure_path"]),
-            )
-            self.load_contest_data(contest_path)
-            print("Contest payout structure loaded.")
+            self.slate_files.append(contest_path)
+        self.slate_key = self.get_slate_key(self.slate_files, self.slate_config_keys)
+        snapshot_path = None
+        if self.use_slate_cache:
+            snapshot_path = os.path.join(self.cache_dir, "slate_{}.npz".format(self.slate_key))
+
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            self.load_slate_snapshot(snapshot_path)
+            print("Slate loaded from snapshot {}".format(os.path.basename(snapshot_path)))
         else:
+            self.load_projections(projection_path)
+            self.load_player_ids(player_path)
+            self.load_team_stacks()
+
+            # ownership_path = os.path.join(
+            #    os.path.dirname(__file__),
+            #    "../{}_data/{}".format(site, self.config["ownership_path"]),
+            # )
+            # self.load_ownership(ownership_path)
+
+            # boom_bust_path = os.path.join(
+            #    os.path.dirname(__file__),
+            #    "../{}_data/{}".format(site, self.config["boom_bust_path"]),
+            # )
+            # self.load_boom_bust(boom_bust_path)
+
+            #       batting_order_path = os.path.join(
+            #           os.path.dirname(__file__),
+            #            "../{}_data/{}".format(site, self.config["batting_order_path"]),
+            #        )
+            #        self.load_batting_order(batting_order_path)
+
+            if use_contest_data:
+                self.load_contest_data(contest_path)
+                print("Contest payout structure loaded.")
+
+            # self.adjust_default_stdev()
+            self.get_optimal()
+            if snapshot_path is not None:
+                self.save_slate_snapshot(snapshot_path)
+
+        if not use_contest_data:
             self.field_size = int(field_size)
-            self.payout_structure = {0: 0.0}
             self.entry_fee = 0
+            self.payouts = PayoutBands([0], [1], [0.0], self.field_size, self.entry_fee)
 
-        # self.adjust_default_stdev()
         self.num_iterations = int(num_iterations)
-        self.get_optimal()
+        self.field_lineups = FieldLineups(self.player_table.ids, len(self.roster_construction))
         if self.use_lineup_input:
             self.load_lineups_from_file()
         # if self.match_lineup_input_to_field_size or len(self.field_lineups) == 0:
         # self.generate_field_lineups()
         self.load_correlation_rules()
+        self.compile_correlations()
+        if self.config.get("late_swap_path"):
+            self.load_actual_scores(os.path.join(
+                os.path.dirname(__file__),
+                "../{}_data/{}".format(site, self.config["late_swap_path"]),
+            ))
 
     # make column lookups on datafiles case insensitive
     def lower_first(self, iterator):
@@ -134,10 +255,55 @@ class CFB_GPP_Simulator:
         self.overlap_limit = float(self.config['num_players_vs_def'])
         self.pct_field_double_stacks = float(self.config['pct_field_double_stacks'])
         self.correlation_rules = self.config["custom_correlations"]
+        # number of sims ranked at once, peak memory is field_size x sim_chunk_size
+        self.sim_chunk_size = int(self.config.get("sim_chunk_size", 1000))
+        # seed for the game simulations, leave out for different draws on every run
+        self.seed = self.config.get("seed")
+        # how the standard normals behind the game sims are drawn: "random", "antithetic" pairs or "sobol"
+        # (scrambled quasi random), the last two reach the same precision with fewer iterations
+        self.sim_sampler = self.config.get("sim_sampler", "random")
+        # float32 samples halve memory and speed up scoring, at the cost of precision nobody will notice
+        self.sim_dtype = np.float32 if self.config.get("sim_float32", False) else np.float64
+        # "batch" draws field lineups with array operations, "sequential" builds them one at a time
+        self.field_sampler = self.config.get("field_sampler", "batch")
+        # most candidate lineups drawn at once by each worker in the batch sampler
+        self.field_batch_size = int(self.config.get("field_batch_size", 4096))
+        # one pool of workers serves every phase. "process" or "thread" workers, 0 workers means one per core
+        # and a chunksize of 0 lets the pool pick how many tasks to send a worker at a time
+        self.pool_backend = self.config.get("pool_backend", "process")
+        self.pool_chunksize = int(self.config.get("pool_chunksize", 0)) or None
+        # BLAS threads inside every worker, 0 splits the cores evenly between the workers so they don't oversubscribe
+        self.num_workers, self.blas_threads = resolve_worker_threads(self.config)
+        # pin every worker to its own set of cpus, only supported on linux
+        self.pin_workers = bool(self.config.get("pin_workers", False)) and hasattr(os, "sched_setaffinity")
+        # adaptive mode simulates in batches until the top lineups' results are precise enough, treating
+        # num_iterations as the most it may run
+        self.adaptive_sim = bool(self.config.get("adaptive_sim", False))
+        self.adaptive_batch_size = int(self.config.get("adaptive_batch_size", 1000))
+        # lineups (by ROI, or win% without contest data) whose precision decides when to stop
+        self.adaptive_top_n = int(self.config.get("adaptive_top_n", 20))
+        # widest 95% confidence interval (+/- percentage points) allowed for each stat, 0 ignores that stat
+        self.adaptive_precision = {"win": 0.1, "top10": 0.5, "roi": 10.0}
+        self.adaptive_precision.update(self.config.get("adaptive_precision", {}))
+        # seconds, stop after the batch that goes over it. 0 means no time limit
+        self.adaptive_time_budget = float(self.config.get("adaptive_time_budget", 0))
+        # keep the samples and every unique lineup's scores after a sim so update_players can re-simulate
+        # only what a news update touches. costs unique lineups x num_iterations floats of memory
+        self.incremental_sim = bool(self.config.get("incremental_sim", False))
+        # keep a snapshot of every parsed slate in the cache dir so unchanged re-runs start instantly
+        self.use_slate_cache = self.config.get("slate_cache", True)
+        # number of lineups select_portfolio picks after a sim, 0 doesn't keep the per sim payouts it needs
+        self.portfolio_size = int(self.config.get("portfolio_size", 0))
+        # how much a lineup's winnings count in sims the portfolio has already won, for every pick that won there
+        self.portfolio_overlap_discount = float(self.config.get("portfolio_overlap_discount", 0.5))
+        # keep the per sim payouts in a file in the cache dir instead of memory
+        self.portfolio_memmap = bool(self.config.get("portfolio_memmap", False))
 
     # In order to make reasonable tournament lineups, we want to be close enough to the optimal that
     # a person could realistically land on this lineup. Skeleton here is taken from base `mlb_optimizer.py`
     def get_optimal(self):
+        # pulp is only needed here, so importing it lazily keeps it out of startup and the pool workers
+        import pulp as plp
 
         # print(s['Name'],s['ID'])
         print(self.player_dict)
@@ -315,38 +481,97 @@ class CFB_GPP_Simulator:
                     self.player_dict[(player_name, pos_str, team)]["Opp"] = team_opp
                     self.player_dict[(player_name, pos_str, team)]["Matchup"] = opp
                 self.id_name_dict[str(row["id"])] = row[name_key]
+        self.player_table = PlayerTable(self.player_dict)
 
 
 
     def load_contest_data(self, path):
+        self.payouts = self.read_contest_structure(path)
+        self.field_size = self.payouts.field_size
+        self.entry_fee = self.payouts.entry_fee
+
+    def read_contest_structure(self, path):
+        # payouts are kept as bands of places paying the same amount, so a "1001-250000" row is one band
+        # instead of a quarter million entries. the field size and entry fee come from the first row
+        field_size = None
+        entry_fee = None
+        starts = []
+        ends = []
+        amounts = []
         with open(path, encoding="utf-8-sig") as file:
             reader = csv.DictReader(self.lower_first(file))
             for row in reader:
-                if self.field_size is None:
-                    self.field_size = int(row["field size"])
-                if self.entry_fee is None:
-                    self.entry_fee = float(row["entry fee"])
+                if field_size is None:
+                    field_size = int(row["field size"])
+                if entry_fee is None:
+                    entry_fee = float(row["entry fee"])
                 # multi-position payouts
                 if "-" in row["place"]:
                     indices = row["place"].split("-")
-                    # print(indices)
-                    # have to add 1 to range to get it to generate value for everything
-                    for i in range(int(indices[0]), int(indices[1]) + 1):
-                        # print(i)
-                        # Where I'm from, we 0 index things. Thus, -1 since Payout starts at 1st place
-                        if i >= self.field_size:
-                            break
-                        self.payout_structure[i - 1] = float(
-                            row["payout"].split(".")[0].replace(",", "")
-                        )
+                    first, last = int(indices[0]), int(indices[1])
                 # single-position payouts
                 else:
-                    if int(row["place"]) >= self.field_size:
+                    first = last = int(row["place"])
+                    if first >= field_size:
                         break
-                    self.payout_structure[int(row["place"]) - 1] = float(
-                        row["payout"].split(".")[0].replace(",", "")
-                    )
-        # print(self.payout_structure)
+                # Where I'm from, we 0 index things. Thus, -1 since Payout starts at 1st place.
+                # places from field size on are never paid
+                if first >= field_size:
+                    continue
+                starts.append(first - 1)
+                ends.append(min(last, field_size - 1))
+                amounts.append(float(row["payout"].split(".")[0].replace(",", "")))
+        return PayoutBands(starts, ends, amounts, field_size, entry_fee)
+
+    def get_slate_key(self, paths, config_keys=()):
+        # snapshots are keyed by the contents of every file that goes into the parsed slate and the settings in
+        # config_keys. bump slate_snapshot_version whenever the parsing changes so old snapshots stop matching
+        key = hashlib.sha1("{} {} {}".format(self.slate_snapshot_version, self.site, self.use_contest_data).encode())
+        for path in paths:
+            with open(path, "rb") as f:
+                key.update(hashlib.sha1(f.read()).digest())
+        settings = {k: self.config.get(k) for k in config_keys}
+        key.update(json.dumps(settings, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def save_slate_snapshot(self, path):
+        # player_dict and id_name_dict go in as json so loading the snapshot never has to unpickle anything
+        players = [[list(k), v] for k, v in self.player_dict.items()]
+        snapshot = {
+            "players": np.array(json.dumps(players)),
+            "id_names": np.array(json.dumps(self.id_name_dict)),
+            "matchups": np.array(list(self.matchups), dtype=str).reshape(-1, 2),
+            "stack_teams": np.array(list(self.stacks_dict.keys()), dtype=str),
+            "stack_ownership": np.array(list(self.stacks_dict.values()), dtype=float),
+            "optimal_score": np.array(self.optimal_score, dtype=float),
+        }
+        if self.use_contest_data:
+            snapshot["payout_bands"] = np.array([self.payouts.starts, self.payouts.ends, self.payouts.amounts])
+            snapshot["contest"] = np.array([self.field_size, self.entry_fee], dtype=float)
+        # write to a temp file first so a run that gets interrupted never leaves a partial snapshot
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **snapshot)
+        os.replace(tmp_path, path)
+
+    def load_slate_snapshot(self, path):
+        with np.load(path) as snapshot:
+            self.player_dict = {}
+            for key, player in json.loads(snapshot["players"].item()):
+                if "Matchup" in player:
+                    player["Matchup"] = tuple(player["Matchup"])
+                self.player_dict[tuple(key)] = player
+            self.id_name_dict = json.loads(snapshot["id_names"].item())
+            self.matchups = set(tuple(m) for m in snapshot["matchups"].tolist())
+            self.stacks_dict = dict(zip(snapshot["stack_teams"].tolist(), snapshot["stack_ownership"].tolist()))
+            self.optimal_score = float(snapshot["optimal_score"])
+            if self.use_contest_data:
+                field_size, self.entry_fee = snapshot["contest"].tolist()
+                self.field_size = int(field_size)
+                starts, ends, amounts = snapshot["payout_bands"]
+                self.payouts = PayoutBands(starts, ends, amounts, self.field_size, self.entry_fee)
+        self.player_table = PlayerTable(self.player_dict)
 
     def load_correlation_rules(self):
         if len(self.correlation_rules.keys()) > 0:
@@ -356,6 +581,57 @@ class CFB_GPP_Simulator:
                         for v in self.correlation_rules[c].keys():
                             self.player_dict[k]['Correlations'][v] = self.correlation_rules[c][v]
 
+    def load_actual_scores(self, path):
+        # actual fantasy points of players whose games have started, by "ID" or "Name" (and "Team" when names
+        # repeat). a game with any actual score is locked: its players keep their actual scores in every sim,
+        # players that aren't listed score 0, and only the unlocked games are simulated
+        table = self.player_table
+        self.locked_fpts = np.full(len(table), np.nan)
+        names = np.array([name.replace("-", "#").lower().strip() for name in table.names])
+        with open(path, encoding="utf-8-sig") as file:
+            reader = csv.DictReader(self.lower_first(file))
+            for row in reader:
+                if row.get("id"):
+                    rows = table.rows([row["id"].strip()])
+                    rows = rows[rows >= 0]
+                else:
+                    match = names == row["name"].replace("-", "#").lower().strip()
+                    if row.get("team"):
+                        match &= table.teams == row["team"].strip()
+                    rows = np.where(match)[0]
+                if len(rows) != 1:
+                    print("{} matches {} players, skipping its actual score".format(row.get("id") or row["name"], len(rows)))
+                    continue
+                self.locked_fpts[rows[0]] = float(row["fpts"])
+        num_players = np.count_nonzero(~np.isnan(self.locked_fpts))
+        locked_games = 0
+        for m, game, on_team1 in self.get_games():
+            if self.is_game_locked(game):
+                locked_games += 1
+                self.locked_fpts[game] = np.nan_to_num(self.locked_fpts[game], nan=0.0)
+        print("Late swap: {} actual scores loaded, {} of {} games locked".format(
+            num_players, locked_games, len(self.matchups)))
+
+    def is_game_locked(self, game):
+        # whether the players in game (player rows) already have actual scores
+        return self.locked_fpts is not None and bool(np.any(~np.isnan(self.locked_fpts[game])))
+
+    # compile the per player correlation dicts (after custom correlations are applied) into integer indexed
+    # tables so game covariance matrices can be built with array operations instead of dict lookups
+    def compile_correlations(self):
+        players = list(self.player_dict.values())
+        num_positions = len(self.correlation_positions)
+        self.team_indices = collections.defaultdict(list)
+        self.position_codes = np.zeros(len(players), dtype=np.int64)
+        # first half of each row is vs same team positions, second half is vs 'Opp ' positions
+        self.correlation_table = np.zeros(shape=(len(players), 2 * num_positions))
+        for i, player in enumerate(players):
+            self.team_indices[player["Team"]].append(i)
+            self.position_codes[i] = self.correlation_positions.index(player["Position"][0])
+            for j, pos in enumerate(self.correlation_positions):
+                self.correlation_table[i, j] = player["Correlations"].get(pos, 0)
+                self.correlation_table[i, num_positions + j] = player["Correlations"].get("Opp " + pos, 0)
+
     # Load config from file
     def load_config(self):
         with open(
@@ -462,87 +738,121 @@ class CFB_GPP_Simulator:
         for team, own_percentage in qb_ownership_by_team.items():
             self.stacks_dict[team] = own_percentage
 
-    def extract_id(self, cell_value):
-        if "(" in cell_value and ")" in cell_value:
-            return cell_value.split("(")[1].replace(")", "")
-        else:
-            return cell_value
-
     def load_lineups_from_file(self):
         print("loading lineups")
-        i = 0
+        lineups = self.read_lineup_file("tournament_lineups.csv", self.field_size)
+        # storing if this lineup was made by an optimizer or with the generation process in this script
+        self.field_lineups.append(lineups, "input")
+        print("loaded {} lineups".format(len(lineups)))
+
+    def load_entries(self, filename="entries.csv"):
+        # our own entries, in the same format as tournament_lineups.csv. they take up places in the contest, so
+        # the field is generated with that many fewer lineups
+        print("loading entries")
+        self.entries = self.read_lineup_file(filename)
+        print("loaded {} entries".format(len(self.entries)))
+
+    def read_lineup_file(self, filename, max_lineups=None):
+        # reads lineups from a file in the site's data folder, returns the valid ones as player rows in
+        # temp_roster_construction order
+        import pandas as pd
         path = os.path.join(
             os.path.dirname(__file__),
-            "../{}_data/{}".format(self.site, "tournament_lineups.csv"),
+            "../{}_data/{}".format(self.site, filename),
         )
+        num_slots = len(self.roster_construction)
+        # read every cell as a string so ids keep their formatting, only the first num_slots columns are players
         with open(path) as file:
-            reader = pd.read_csv(file)
-            lineup = []
-            j = 0
-            for i, row in reader.iterrows():
-                # print(row)
-                if i == self.field_size:
-                    break
-                lineup = [self.extract_id(str(row[j])) for j in range(9)]
-                # storing if this lineup was made by an optimizer or with the generation process in this script
-                error = False
-                for l in lineup:
-                    ids = [self.player_dict[k]['ID'] for k in self.player_dict]
-                    if l not in ids:
-                        print("lineup {} is missing players {}".format(i, l))
-                        if l in self.id_name_dict:
-                            print(self.id_name_dict[l])
-                        error = True
-                if len(lineup) < 8:
-                    print("lineup {} is missing players".format(i))
-                    continue
-                # storing if this lineup was made by an optimizer or with the generation process in this script
-                error = False
-                for l in lineup:
-                    ids = [self.player_dict[k]['ID'] for k in self.player_dict]
-                    if l not in ids:
-                        print("lineup {} is missing players {}".format(i, l))
-                        if l in self.id_name_dict:
-                            print(self.id_name_dict[l])
-                        error = True
-                if len(lineup) < 8:
-                    print("lineup {} is missing players".format(i))
-                    continue
-                if not error:
-                    # reshuffle lineup to match temp_roster_construction
-                    temp_roster_construction = ['S-FLEX', 'QB', 'RB', 'RB', 'WR', 'WR', 'WR', 'FLEX']
-                    shuffled_lu = []
-
-                    id_to_player_dict = {v["ID"]: v for k, v in self.player_dict.items()}
-                    lineup_copy = lineup.copy()
-                    position_counts = {'S-FLEX': 0, 'QB': 0, 'RB': 0, 'WR': 0, 'FLEX': 0}
-                    z = 0
-
-                    while z < 8:
-                        for t in temp_roster_construction:
-                            if position_counts[t] < temp_roster_construction.count(t):
-                                for l in lineup_copy:
-                                    player_info = id_to_player_dict.get(l)
-                                    if player_info and t in player_info['Position']:
-                                        shuffled_lu.append(l)
-                                        lineup_copy.remove(l)
-                                        position_counts[t] += 1
-                                        z += 1
-                                        if z == 8:
-                                            break
-                            if z == 8:
-                                break
-                    self.field_lineups[j] = {
-                        "Lineup": shuffled_lu,
-                        "Wins": 0,
-                        "Top10": 0,
-                        "ROI": 0,
-                        "Cashes": 0,
-                        "Type": "input",
-                    }
-                    j += 1
-        print("loaded {} lineups".format(j))
-        # print(self.field_lineups)
+            reader = pd.read_csv(file, dtype=str, nrows=max_lineups)
+        cells = reader.iloc[:, :num_slots]
+        # files with fewer columns than roster slots get empty players, so those lineups come out invalid
+        if cells.shape[1] < num_slots:
+            print("{} has {} player columns, lineups need {}".format(filename, cells.shape[1], num_slots))
+        for i in range(cells.shape[1], num_slots):
+            cells = cells.assign(**{"missing slot {}".format(i): ""})
+        # players can either be "name (id)" or just the id
+        cells = cells.apply(lambda col: col.str.extract(r'\(([^)]*)\)', expand=False).fillna(col))
+        ids = cells.to_numpy(dtype=object)
+        # one lookup maps every id in the file to its player row, ids that aren't on the slate become -1
+        rows = pd.Series(ids.ravel()).map(self.player_table.index).fillna(-1).to_numpy(dtype=np.int64)
+        rows = rows.reshape(-1, num_slots)
+        for i in np.where(np.any(rows < 0, axis=1))[0]:
+            for l in ids[i][rows[i] < 0]:
+                print("lineup {} is missing players {}".format(i, l))
+                if l in self.id_name_dict:
+                    print(self.id_name_dict[l])
+        lineups, valid = self.assign_roster_slots(rows)
+        for i in np.where(~valid & np.all(rows >= 0, axis=1))[0]:
+            print("lineup {} can't fill every roster spot with players {}".format(i, list(ids[i])))
+        return lineups[valid]
+
+    def assign_roster_slots(self, rows):
+        # rows is (lineups, num_slots) player rows in any order. returns the lineups reordered to match
+        # temp_roster_construction, and whether each lineup could fill every slot with different players
+        temp_roster_construction = ['S-FLEX', 'QB', 'RB', 'RB', 'WR', 'WR', 'WR', 'FLEX']
+        num_lineups, num_slots = rows.shape
+        lineup_range = np.arange(num_lineups)
+        slot_bits = np.array([PlayerTable.position_bits[pos] for pos in temp_roster_construction])
+        # eligible[lineup, player, slot]
+        position_mask = self.player_table.position_mask[np.maximum(rows, 0)]
+        eligible = ((position_mask[:, :, None] & slot_bits) > 0) & (rows >= 0)[:, :, None]
+        # players that fit the fewest slots are placed first, leaving flexible players for the slots they open up
+        flexibility = eligible.sum(axis=2)
+        sorted_rows = np.sort(rows, axis=1)
+        valid = np.all(rows >= 0, axis=1) & np.all(sorted_rows[:, 1:] != sorted_rows[:, :-1], axis=1)
+        lineups = np.full(rows.shape, -1)
+        used = np.zeros(rows.shape, dtype=bool)
+        # most restrictive slots first, S-FLEX takes whoever is left
+        for slot in [1, 2, 3, 4, 5, 6, 7, 0]:
+            options = np.where(eligible[:, :, slot] & ~used, flexibility, num_slots + 1)
+            choice = np.argmin(options, axis=1)
+            valid &= options[lineup_range, choice] <= num_slots
+            lineups[:, slot] = rows[lineup_range, choice]
+            used[lineup_range, choice] = True
+        return lineups, valid
+
+    @staticmethod
+    def build_alias_table(weights):
+        # Walker's alias method, O(n) to build and O(1) per weighted draw: pick a column uniformly, keep it with
+        # probability prob[column], otherwise take alias[column]
+        n = len(weights)
+        prob = weights * n / weights.sum()
+        alias = np.arange(n)
+        small = [i for i in range(n) if prob[i] < 1]
+        large = [i for i in range(n) if prob[i] >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            alias[s] = l
+            prob[l] -= 1 - prob[s]
+            if prob[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left over is only off from 1 by rounding
+        prob[small + large] = 1
+        return prob, alias
+
+    @staticmethod
+    def build_slot_tables(pos_matrix, ownership):
+        # ownership weighted alias tables for every roster slot, built once per slate. tables for all slots are
+        # concatenated, slot s owns entries offsets[s]:offsets[s + 1] and candidates holds player indices
+        offsets = [0]
+        candidates = []
+        probs = []
+        aliases = []
+        for pos in pos_matrix.T:
+            # players with no ownership can never be drawn, so leave them out of the tables
+            slot_candidates = np.where((pos > 0) & (ownership > 0))[0]
+            if len(slot_candidates) > 0:
+                prob, alias = CFB_GPP_Simulator.build_alias_table(ownership[slot_candidates].astype(float))
+            else:
+                prob, alias = np.zeros(0), np.zeros(0, dtype=np.int64)
+            offsets.append(offsets[-1] + len(slot_candidates))
+            candidates.append(slot_candidates)
+            probs.append(prob)
+            aliases.append(alias)
+        return np.array(offsets), np.concatenate(candidates), np.concatenate(probs), np.concatenate(aliases)
 
     @staticmethod
     def generate_lineups(
@@ -563,10 +873,34 @@ class CFB_GPP_Simulator:
             stack_len,
             overlap_limit,
             max_stack_len,
-            matchups
+            matchups,
+            slot_tables=None
     ):
         # new random seed for each lineup (without this there is a ton of dupes)
         np.random.seed(lu_num)
+        if slot_tables is None:
+            slot_tables = CFB_GPP_Simulator.build_slot_tables(pos_matrix, ownership)
+        offsets, candidates, slot_prob, slot_alias = slot_tables
+
+        def pick(slot, exclude_team=None, exclude_opp=None):
+            # ownership weighted draw of a player index for the slot from its alias table. players already in the
+            # lineup, on exclude_team or facing exclude_opp are redrawn, which leaves the odds of everyone else as is
+            start = offsets[slot]
+            num_candidates = offsets[slot + 1] - start
+            for _ in range(100):
+                if num_candidates == 0:
+                    break
+                i = start + np.random.randint(num_candidates)
+                p = candidates[i] if np.random.random() < slot_prob[i] else candidates[start + slot_alias[i]]
+                if in_lineup[p] == 0 and teams[p] != exclude_team and opponents[p] != exclude_opp:
+                    return p
+            # most of the slot is ruled out, fall back to drawing from exactly the players that are left
+            valid_players = np.where((pos_matrix[:, slot] > 0) & (in_lineup == 0) & (teams != exclude_team) &
+                                     (opponents != exclude_opp))[0]
+            prob_list = ownership[valid_players]
+            prob_list = prob_list / prob_list.sum()
+            return np.random.choice(a=valid_players, p=prob_list)
+
         lus = {}
         # make sure nobody is already showing up in a lineup
         if sum(in_lineup) != 0:
@@ -589,61 +923,23 @@ class CFB_GPP_Simulator:
                 players_opposing_def = 0
                 lineup_matchups = []
                 k = 0
-                for pos in pos_matrix.T:
+                for k in range(pos_matrix.shape[1]):
                     if k < 1:
-                        # check for players eligible for the position and make sure they arent in a lineup, returns a list of indices of available player
-                        valid_players = np.where((pos > 0) & (in_lineup == 0))
-                        # grab names of players eligible
-                        plyr_list = ids[valid_players]
-                        # create np array of probability of being selected based on ownership and who is eligible at the position
-                        prob_list = ownership[valid_players]
-                        prob_list = prob_list / prob_list.sum()
-                        try:
-                            choice = np.random.choice(a=plyr_list, p=prob_list)
-                        except:
-                            print(plyr_list, prob_list)
-                        choice_idx = np.where(ids == choice)[0]
-                        lineup.append(str(choice))
-                        in_lineup[choice_idx] = 1
-                        salary += salaries[choice_idx]
-                        proj += projections[choice_idx]
-                        def_opp = opponents[choice_idx][0]
-                        lineup_matchups.append(matchups[choice_idx[0]])
+                        choice_idx = pick(k)
+                        def_opp = opponents[choice_idx]
+                    elif players_opposing_def < overlap_limit:
+                        choice_idx = pick(k)
+                    else:
+                        choice_idx = pick(k, exclude_team=def_opp)
+                    lineup.append(str(ids[choice_idx]))
+                    in_lineup[choice_idx] = 1
+                    salary += salaries[choice_idx]
+                    proj += projections[choice_idx]
+                    lineup_matchups.append(matchups[choice_idx])
                     if k >= 1:
-                        if players_opposing_def < overlap_limit:
-                            valid_players = np.where((pos > 0) & (in_lineup == 0))
-                            # grab names of players eligible
-                            plyr_list = ids[valid_players]
-                            # create np array of probability of being seelcted based on ownership and who is eligible at the position
-                            prob_list = ownership[valid_players]
-                            prob_list = prob_list / prob_list.sum()
-                            choice = np.random.choice(a=plyr_list, p=prob_list)
-                            choice_idx = np.where(ids == choice)[0]
-                            lineup.append(str(choice))
-                            in_lineup[choice_idx] = 1
-                            salary += salaries[choice_idx]
-                            proj += projections[choice_idx]
-                            player_teams.append(teams[choice_idx][0])
-                            lineup_matchups.append(matchups[choice_idx[0]])
-                            if teams[choice_idx][0] == def_opp:
-                                players_opposing_def += 1
-                        else:
-                            valid_players = np.where((pos > 0) & (in_lineup == 0) & (teams != def_opp))
-                            plyr_list = ids[valid_players]
-                            # create np array of probability of being seelcted based on ownership and who is eligible at the position
-                            prob_list = ownership[valid_players]
-                            prob_list = prob_list / prob_list.sum()
-                            choice = np.random.choice(a=plyr_list, p=prob_list)
-                            choice_idx = np.where(ids == choice)[0]
-                            lineup.append(str(choice))
-                            in_lineup[choice_idx] = 1
-                            salary += salaries[choice_idx]
-                            proj += projections[choice_idx]
-                            player_teams.append(teams[choice_idx][0])
-                            lineup_matchups.append(matchups[choice_idx[0]])
-                            if teams[choice_idx][0] == def_opp:
-                                players_opposing_def += 1
-                    k += 1
+                        player_teams.append(teams[choice_idx])
+                        if teams[choice_idx] == def_opp:
+                            players_opposing_def += 1
                     # Must have a reasonable salary
                 if salary >= salary_floor and salary <= salary_ceiling:
                     # Must have a reasonable projection (within 60% of optimal) **people make a lot of bad lineups
@@ -652,9 +948,8 @@ class CFB_GPP_Simulator:
                     )
                     if proj >= reasonable_projection:
                         if len(set(lineup_matchups)) > 1:
-                            if len(set(lineup)) != 9:
-                                print('non stack lineup dupes', plyr_stack_indices, str(lu_num),
-                                      salaries[plyr_stack_indices], lineup, stack_len, team_stack, x)
+                            if len(set(lineup)) != len(lineup):
+                                print('non stack lineup dupes', str(lu_num), lineup)
                             reject = False
                             lus[lu_num] = {
                                 "Lineup": lineup,
@@ -673,6 +968,8 @@ class CFB_GPP_Simulator:
                     in_lineup.fill(0)
                 player_teams = []
                 def_opps = []
+                # the stack can fill the first slot, in which case nobody sets def_opp below
+                def_opp = None
                 lineup_matchups = []
                 filled_pos = np.zeros(shape=pos_matrix.shape[1])
                 team_stack_len = 0
@@ -691,19 +988,16 @@ class CFB_GPP_Simulator:
                 lineup_matchups.append(matchups[qb])
                 valid_players = np.unique(valid_team[np.where(pos_matrix[valid_team, 4:8] > 0)[0]])
                 players_opposing_def = 0
-                plyr_list = ids[valid_players]
+                plyr_stack_indices = []
                 prob_list = ownership[valid_players]
                 prob_list = prob_list / prob_list.sum()
                 while stack:
                     try:
-                        choices = np.random.choice(a=plyr_list, p=prob_list, size=stack_len, replace=False)
-                        if len(set(choices)) != len(choices):
-                            print('choice dupe', plyr_stack_indices, str(lu_num), salaries[plyr_stack_indices], lineup,
-                                  stack_len, team_stack, x)
+                        plyr_stack_indices = np.sort(
+                            np.random.choice(a=valid_players, p=prob_list, size=stack_len, replace=False))
                     except:
                         stack = False
                         continue
-                    plyr_stack_indices = np.where(np.in1d(ids, choices))[0]
                     x = 0
                     for p in plyr_stack_indices:
                         player_placed = False
@@ -729,68 +1023,27 @@ class CFB_GPP_Simulator:
                     else:
                         stack = False
                 # print(sum(in_lineup), stack_len)
-                for ix, (l, pos) in enumerate(zip(lineup, pos_matrix.T)):
+                for ix, l in enumerate(lineup):
                     if l == '0.0':
                         if k < 1:
-                            valid_players = np.where((pos > 0) & (in_lineup == 0) & (opponents != team_stack))
-                            # grab names of players eligible
-                            plyr_list = ids[valid_players]
-                            # create np array of probability of being selected based on ownership and who is eligible at the position
-                            prob_list = ownership[valid_players]
-                            prob_list = prob_list / prob_list.sum()
-                            # try:
-                            choice = np.random.choice(a=plyr_list, p=prob_list)
-                            # except:
-                            #    print(k, pos)
-                            choice_idx = np.where(ids == choice)[0]
-                            in_lineup[choice_idx] = 1
-                            lineup[ix] = str(choice)
-                            salary += salaries[choice_idx]
-                            proj += projections[choice_idx]
-                            def_opp = opponents[choice_idx][0]
-                            lineup_matchups.append(matchups[choice_idx[0]])
-                            k += 1
-                        elif k >= 1:
-                            if players_opposing_def < overlap_limit:
-                                valid_players = np.where((pos > 0) & (in_lineup == 0))
-                                # grab names of players eligible
-                                plyr_list = ids[valid_players]
-                                # create np array of probability of being seelcted based on ownership and who is eligible at the position
-                                prob_list = ownership[valid_players]
-                                prob_list = prob_list / prob_list.sum()
-                                choice = np.random.choice(a=plyr_list, p=prob_list)
-                                choice_idx = np.where(ids == choice)[0]
-                                lineup[ix] = str(choice)
-                                in_lineup[choice_idx] = 1
-                                salary += salaries[choice_idx]
-                                proj += projections[choice_idx]
-                                player_teams.append(teams[choice_idx][0])
-                                lineup_matchups.append(matchups[choice_idx[0]])
-                                if teams[choice_idx][0] == def_opp:
-                                    players_opposing_def += 1
-                                if teams[choice_idx][0] == team_stack:
-                                    team_stack_len += 1
-                            else:
-                                valid_players = np.where((pos > 0) & (in_lineup == 0) & (teams != def_opp))
-                                plyr_list = ids[valid_players]
-                                # create np array of probability of being seelcted based on ownership and who is eligible at the position
-                                prob_list = ownership[valid_players]
-                                prob_list = prob_list / prob_list.sum()
-                                choice = np.random.choice(a=plyr_list, p=prob_list)
-                                choice_idx = np.where(ids == choice)[0]
-                                lineup[ix] = str(choice)
-                                in_lineup[choice_idx] = 1
-                                salary += salaries[choice_idx]
-                                proj += projections[choice_idx]
-                                player_teams.append(teams[choice_idx][0])
-                                lineup_matchups.append(matchups[choice_idx[0]])
-                                if teams[choice_idx][0] == def_opp:
-                                    players_opposing_def += 1
-                                if teams[choice_idx][0] == team_stack:
-                                    team_stack_len += 1
-                            k += 1
-                    else:
-                        k += 1
+                            choice_idx = pick(ix, exclude_opp=team_stack)
+                            def_opp = opponents[choice_idx]
+                        elif players_opposing_def < overlap_limit:
+                            choice_idx = pick(ix)
+                        else:
+                            choice_idx = pick(ix, exclude_team=def_opp)
+                        in_lineup[choice_idx] = 1
+                        lineup[ix] = str(ids[choice_idx])
+                        salary += salaries[choice_idx]
+                        proj += projections[choice_idx]
+                        lineup_matchups.append(matchups[choice_idx])
+                        if k >= 1:
+                            player_teams.append(teams[choice_idx])
+                            if teams[choice_idx] == def_opp:
+                                players_opposing_def += 1
+                            if teams[choice_idx] == team_stack:
+                                team_stack_len += 1
+                    k += 1
                 # Must have a reasonable salary
                 if team_stack_len >= stack_len:
                     if salary >= salary_floor and salary <= salary_ceiling:
@@ -809,9 +1062,9 @@ class CFB_GPP_Simulator:
                                     "Cashes": 0,
                                     "Type": "generated_stack",
                                 }
-                                if len(set(lineup)) != 9:
+                                if len(set(lineup)) != len(lineup):
                                     print('stack lineup dupes', lu_num, plyr_stack_indices, str(lu_num),
-                                          salaries[plyr_stack_indices], lineup, stack_len, team_stack, x)
+                                          salaries[plyr_stack_indices], lineup, stack_len, team_stack)
                 #                 complete = 'completed'
                 #                 print(str(lu_num) + ' ' + complete)
                 #             else:
@@ -828,8 +1081,166 @@ class CFB_GPP_Simulator:
                 #     print(lu_num, team_stack, overlap_limit, max_stack_len, issue, iteration_count)
         return lus
 
+    @staticmethod
+    def generate_lineup_batch(start, stacks, stack_lens, slate):
+        # vectorized generate_lineups: every lineup in stacks/stack_lens is drawn at once, one roster slot at a time
+        # for the whole batch. a draw is the argmax of log ownership plus Gumbel noise over the eligible players,
+        # which picks players with the same ownership weighted odds as np.random.choice. candidates failing the
+        # salary, projection, stack or matchup checks are masked out and redrawn until every lineup is filled
+        rng = np.random.default_rng(start)
+        ids = slate["ids"]
+        pos_matrix = slate["pos_matrix"]
+        salaries = slate["salaries"]
+        projections = slate["projections"]
+        matchups = slate["matchups"]
+        num_players, num_slots = pos_matrix.shape
+        max_stack_len = slate["max_stack_len"]
+        eligible = pos_matrix.T > 0
+        # ownership weighted draws only need log ownership, players with 0 ownership are never picked
+        with np.errstate(divide="ignore"):
+            log_own = np.log(slate["ownership"])
+        team_codes = slate["team_codes"]
+        opp_codes = slate["opp_codes"]
+        team_lookup = {t: i for i, t in enumerate(slate["team_names"])}
+        # like generate_lineups, a team's stack is built around its first QB and players from the WR/FLEX slots
+        team_qb = np.full(len(team_lookup), -1)
+        for p in np.where(eligible[1] & (team_codes >= 0))[0][::-1]:
+            team_qb[team_codes[p]] = p
+        stack_eligible = pos_matrix[:, 4:8].any(axis=1)
+        stack_teams = np.array([team_lookup.get(t, -1) if t != '' else -1 for t in stacks])
+        stack_teams[team_qb[stack_teams] < 0] = -1
+        stack_lens = np.asarray(stack_lens)
+        nostack_floor = slate["optimal_score"] - slate["max_pct_off_optimal"] * slate["optimal_score"]
+        # loosening reasonable projection constraint for team stacks
+        stack_floor = slate["optimal_score"] - (slate["max_pct_off_optimal"] * 1.25) * slate["optimal_score"]
+
+        def pick(mask):
+            # one ownership weighted draw per row among the players in its mask, -1 where the mask is empty
+            keys = np.where(mask, log_own + rng.gumbel(size=mask.shape), -np.inf)
+            choice = np.argmax(keys, axis=1)
+            return np.where(np.isfinite(keys[np.arange(len(mask)), choice]), choice, -1)
+
+        def draw(stack_team, stack_len):
+            num_rows = len(stack_team)
+            lineup = np.full((num_rows, num_slots), -1)
+            used = np.zeros((num_rows, num_players), dtype=bool)
+            valid = np.ones(num_rows, dtype=bool)
+            stacked = np.where(stack_team >= 0)[0]
+            qbs = team_qb[stack_team[stacked]]
+            lineup[stacked, 1] = qbs
+            used[stacked, qbs] = True
+            stack_picks = np.full((num_rows, max_stack_len), num_players)
+            for j in range(max_stack_len):
+                rows = stacked[stack_len[stacked] > j]
+                mask = stack_eligible & (team_codes == stack_team[rows, None]) & ~used[rows]
+                choice = pick(mask)
+                valid[rows[choice < 0]] = False
+                rows, choice = rows[choice >= 0], choice[choice >= 0]
+                used[rows, choice] = True
+                stack_picks[rows, j] = choice
+            # stack players go in their first open eligible slot, lowest player index first
+            stack_picks.sort(axis=1)
+            for j in range(max_stack_len):
+                rows = np.where(stack_picks[:, j] < num_players)[0]
+                open_slots = eligible[:, stack_picks[rows, j]].T & (lineup[rows] == -1)
+                valid[rows[~open_slots.any(axis=1)]] = False
+                lineup[rows, np.argmax(open_slots, axis=1)] = stack_picks[rows, j]
+            def_opp = np.full(num_rows, -1)
+            players_opposing_def = np.zeros(num_rows)
+            for slot in range(num_slots):
+                rows = np.where(valid & (lineup[:, slot] == -1))[0]
+                mask = eligible[slot] & ~used[rows]
+                if slot == 0:
+                    # first pick of a stack lineup can't face the stacked team
+                    mask &= ~((opp_codes == stack_team[rows, None]) & (stack_team[rows, None] >= 0))
+                else:
+                    # once enough players face the first pick's team, leave that team out
+                    over_limit = (players_opposing_def[rows] >= slate["overlap_limit"]) & (def_opp[rows] >= 0)
+                    mask &= ~(over_limit[:, None] & (team_codes == def_opp[rows, None]))
+                choice = pick(mask)
+                valid[rows[choice < 0]] = False
+                rows, choice = rows[choice >= 0], choice[choice >= 0]
+                lineup[rows, slot] = choice
+                used[rows, choice] = True
+                if slot == 0:
+                    def_opp[rows] = opp_codes[choice]
+                else:
+                    players_opposing_def[rows] += (team_codes[choice] == def_opp[rows]) & (def_opp[rows] >= 0)
+            filled = np.where(lineup >= 0, lineup, 0)
+            salary = salaries[filled].sum(axis=1)
+            proj = projections[filled].sum(axis=1)
+            ok = valid & (salary >= slate["salary_floor"]) & (salary <= slate["salary_ceiling"])
+            ok &= proj >= np.where(stack_team >= 0, stack_floor, nostack_floor)
+            # stacks need at least stack_len players (QB included) from the stacked team
+            ok &= (stack_team < 0) | ((team_codes[filled] == stack_team[:, None]).sum(axis=1) >= stack_len)
+            # lineups need players from more than one game
+            ok &= (matchups[filled] != matchups[filled[:, :1]]).any(axis=1)
+            return lineup, ok
+
+        lineups = np.full((len(stacks), num_slots), -1)
+        pending = np.arange(len(stacks))
+        acceptance = 1.0
+        while len(pending) > 0:
+            # oversample by the expected number of draws per accepted lineup, keeping batches a bounded size
+            batch = pending[:slate["field_batch_size"]]
+            copies = int(min(math.ceil(1.5 / max(acceptance, 0.01)), max(1, slate["field_batch_size"] // len(batch))))
+            requests = np.repeat(batch, copies)
+            candidates, ok = draw(stack_teams[requests], stack_lens[requests])
+            acceptance = max(ok.mean(), 0.5 * acceptance)
+            accepted, first = np.unique(requests[ok], return_index=True)
+            lineups[accepted] = candidates[ok][first]
+            pending = pending[~np.isin(pending, accepted)]
+
+        types = np.where(stack_teams >= 0, FieldLineups.lineup_types.index("generated_stack"),
+                         FieldLineups.lineup_types.index("generated_nostack"))
+        return lineups.astype(np.int32), types.astype(np.int8)
+
+    @staticmethod
+    def generate_lineup_range(start, stacks, stack_lens):
+        # runs in a pool worker, the slate arrays come from shared memory set up by attach_shared_arrays.
+        # returns the lineups as player indices along with their FieldLineups type codes
+        if shared_arrays["field_sampler"] == "batch":
+            return CFB_GPP_Simulator.generate_lineup_batch(start, stacks, stack_lens, shared_arrays)
+        in_lineup = np.zeros(shape=len(shared_arrays["ids"]))
+        slot_tables = (
+            shared_arrays["slot_offsets"],
+            shared_arrays["slot_candidates"],
+            shared_arrays["slot_prob"],
+            shared_arrays["slot_alias"],
+        )
+        player_index = {p: i for i, p in enumerate(shared_arrays["ids"])}
+        lineups = np.zeros(shape=(len(stacks), shared_arrays["pos_matrix"].shape[1]), dtype=np.int32)
+        types = np.zeros(shape=len(stacks), dtype=np.int8)
+        for i, (team_stack, stack_len) in enumerate(zip(stacks, stack_lens)):
+            lu_num = start + i
+            lus = CFB_GPP_Simulator.generate_lineups(
+                lu_num,
+                shared_arrays["ids"],
+                in_lineup,
+                shared_arrays["pos_matrix"],
+                shared_arrays["ownership"],
+                shared_arrays["salary_floor"],
+                shared_arrays["salary_ceiling"],
+                shared_arrays["optimal_score"],
+                shared_arrays["salaries"],
+                shared_arrays["projections"],
+                shared_arrays["max_pct_off_optimal"],
+                shared_arrays["teams"],
+                shared_arrays["opponents"],
+                team_stack,
+                stack_len,
+                shared_arrays["overlap_limit"],
+                shared_arrays["max_stack_len"],
+                shared_arrays["matchups"],
+                slot_tables,
+            )
+            lineups[i] = [player_index[p] for p in lus[lu_num]["Lineup"]]
+            types[i] = FieldLineups.lineup_types.index(lus[lu_num]["Type"])
+        return lineups, types
+
     def generate_field_lineups(self):
-        diff = self.field_size - len(self.field_lineups)
+        num_entries = 0 if self.entries is None else len(self.entries)
+        diff = self.field_size - len(self.field_lineups) - num_entries
         if diff <= 0:
             print(
                 "supplied lineups >= contest field size. only retrieving the first "
@@ -838,55 +1249,12 @@ class CFB_GPP_Simulator:
             )
         else:
             print('Generating ' + str(diff) + ' lineups.')
-            ids = []
-            ownership = []
-            salaries = []
-            projections = []
-            positions = []
-            teams = []
-            opponents = []
-            matchups = []
-            # put def first to make it easier to avoid overlap
-            temp_roster_construction = ['S-FLEX', 'QB', 'RB', 'RB', 'WR', 'WR', 'WR', 'FLEX']
-            for k in self.player_dict.keys():
-                if 'Team' not in self.player_dict[k].keys():
-                    print(self.player_dict[k]['Name'], ' name mismatch between projections and player ids!')
-                ids.append(self.player_dict[k]['ID'])
-                ownership.append(self.player_dict[k]['Ownership'])
-                salaries.append(self.player_dict[k]['Salary'])
-                if self.player_dict[k]['Fpts'] >= self.projection_minimum:
-                    projections.append(self.player_dict[k]['Fpts'])
-                else:
-                    projections.append(0)
-                teams.append(self.player_dict[k]['Team'])
-                opponents.append(self.player_dict[k]['Opp'])
-                matchups.append(self.player_dict[k]['Matchup'])
-                pos_list = []
-                for pos in temp_roster_construction:
-                    if pos in self.player_dict[k]['Position']:
-                        pos_list.append(1)
-                    else:
-                        pos_list.append(0)
-                positions.append(np.array(pos_list))
-            in_lineup = np.zeros(shape=len(ids))
-            ownership = np.array(ownership)
-            salaries = np.array(salaries)
-            projections = np.array(projections)
-            pos_matrix = np.array(positions)
-            ids = np.array(ids)
-            optimal_score = self.optimal_score
-            salary_floor = self.min_lineup_salary
-            salary_ceiling = self.salary
-            max_pct_off_optimal = self.max_pct_off_optimal
-            stack_usage = self.pct_field_using_stacks
-            teams = np.array(teams)
-            opponents = np.array(opponents)
-            overlap_limit = self.overlap_limit
-            problems = []
+            table = self.player_table
+            for name in table.names[table.ids == '']:
+                print(name, ' name mismatch between projections and player ids!')
             stacks = np.random.binomial(n=1, p=self.pct_field_using_stacks, size=diff)
             stack_len = np.random.choice(a=[1, 2], p=[1 - self.pct_field_double_stacks, self.pct_field_double_stacks],
                                          size=diff)
-            max_stack_len = 2
             a = list(self.stacks_dict.keys())
             p = np.array(list(self.stacks_dict.values()))
             probs = p / sum(p)
@@ -897,49 +1265,162 @@ class CFB_GPP_Simulator:
                     stacks[i] = choice[0]
                 else:
                     stacks[i] = ''
-            # creating tuples of the above np arrays plus which lineup number we are going to create
-            # q = 0
-            # for k in self.player_dict.keys():
-            # if self.player_dict[k]['Team'] == stacks[0]:
-            #    print(k, self.player_dict[k]['ID'])
-            #    print(positions[q])
-            # q += 1
-            for i in range(diff):
-                lu_tuple = (
-                i, ids, in_lineup, pos_matrix, ownership, salary_floor, salary_ceiling, optimal_score, salaries,
-                projections, max_pct_off_optimal, teams, opponents, stacks[i], stack_len[i], overlap_limit,
-                max_stack_len, matchups)
-                problems.append(lu_tuple)
-            # print(problems[0])
-            # print(stacks)
+            # the slate arrays are already in the workers, tasks only carry a lineup range and its stack assignments
+            num_tasks = self.num_workers * 4
+            task_size = max(1, math.ceil(diff / num_tasks))
+            problems = []
+            for start in range(0, diff, task_size):
+                problems.append((start, stacks[start:start + task_size], stack_len[start:start + task_size]))
             start_time = time.time()
-            with mp.Pool() as pool:
-                output = pool.starmap(self.generate_lineups, problems)
-                print(
-                    "number of running processes =",
-                    pool.__dict__["_processes"]
-                    if (pool.__dict__["_state"]).upper() == "RUN"
-                    else None,
-                )
-                pool.close()
-                pool.join()
-            print('pool closed')
-            if len(self.field_lineups) == 0:
-                new_keys = list(range(0, self.field_size))
-            else:
-                new_keys = list(
-                    range(max(self.field_lineups.keys()) + 1, self.field_size)
-                )
-            nk = new_keys[0]
-            for i, o in enumerate(output):
-                if nk in self.field_lineups.keys():
-                    print("bad lineups dict, please check dk_data files")
-                self.field_lineups[nk] = o[i]
-                nk += 1
+            output = self.get_pool().starmap(self.generate_lineup_range, problems, chunksize=self.pool_chunksize)
+            print("number of pool workers = {} ({})".format(self.num_workers, self.pool_backend))
+            for lineups, types in output:
+                self.field_lineups.append(lineups, types)
             end_time = time.time()
             print("lineups took " + str(end_time - start_time) + " seconds")
             print(str(diff) + " field lineups successfully generated")
             # print(self.field_lineups)
+        self.build_field_matrix()
+
+    def build_slate_arrays(self):
+        # read only slate arrays, and the settings that go with them, that pool workers need in every phase
+        table = self.player_table
+        # put def first to make it easier to avoid overlap
+        temp_roster_construction = ['S-FLEX', 'QB', 'RB', 'RB', 'WR', 'WR', 'WR', 'FLEX']
+        pos_matrix = np.array([table.has_position(pos) for pos in temp_roster_construction]).T.astype(np.int64)
+        # matchups only get compared to each other, so integer codes do
+        matchup_codes = {}
+        matchups = np.array([matchup_codes.setdefault(m, len(matchup_codes)) for m in table.matchups])
+        offsets, candidates, slot_prob, slot_alias = self.build_slot_tables(pos_matrix, table.ownership)
+        slate_arrays = {
+            "slot_offsets": offsets,
+            "slot_candidates": candidates,
+            "slot_prob": slot_prob,
+            "slot_alias": slot_alias,
+            "ids": table.ids,
+            "pos_matrix": pos_matrix,
+            "ownership": table.ownership,
+            "salaries": table.salary,
+            "projections": np.where(table.fpts >= self.projection_minimum, table.fpts, 0),
+            "teams": table.teams,
+            "opponents": table.opponents,
+            "team_names": np.array(table.team_names),
+            "team_codes": table.team_codes,
+            "opp_codes": table.opp_codes,
+            "matchups": matchups,
+            "fpts": table.fpts,
+            "stddevs": table.stddev,
+            "position_codes": self.position_codes,
+            "correlation_table": self.correlation_table,
+        }
+        slate_params = {
+            "salary_floor": self.min_lineup_salary,
+            "salary_ceiling": self.salary,
+            "optimal_score": self.optimal_score,
+            "max_pct_off_optimal": self.max_pct_off_optimal,
+            "overlap_limit": self.overlap_limit,
+            "max_stack_len": 2,
+            "field_sampler": self.field_sampler,
+            "field_batch_size": self.field_batch_size,
+            "cache_dir": self.cache_dir,
+            "sim_dtype": np.dtype(self.sim_dtype).str,
+        }
+        return slate_arrays, slate_params
+
+    def get_cpu_sets(self):
+        # split the cpus this process may run on into one set of blas_threads cpus per worker. workers
+        # share cpus when there aren't enough to go around
+        cpus = sorted(os.sched_getaffinity(0))
+        return [
+            {cpus[(worker * self.blas_threads + i) % len(cpus)] for i in range(self.blas_threads)}
+            for worker in range(self.num_workers)
+        ]
+
+    def print_execution_policy(self):
+        if importlib.util.find_spec("threadpoolctl") is not None:
+            blas_control = "set with threadpoolctl"
+        elif blas_env_threads == str(self.blas_threads):
+            blas_control = "set with environment variables"
+        elif self.pool_backend == "process" and mp.get_start_method() == "spawn":
+            # spawned workers load numpy after get_pool sets the environment, only this process isn't limited
+            blas_control = "set with environment variables in the workers"
+        else:
+            # forked and thread workers use the BLAS this process already loaded with its own thread count
+            blas_control = "not limited, BLAS was loaded before the limit was set"
+            print("Warning: BLAS threads can't be limited to {} per worker. Run through main.py, which sets them "
+                  "before numpy loads, or install threadpoolctl".format(self.blas_threads))
+        print("Execution policy: {} {} workers, {} BLAS threads per worker ({}), {}".format(
+            self.num_workers, self.pool_backend, self.blas_threads, blas_control,
+            "pinned to cpus {}".format([sorted(c) for c in self.get_cpu_sets()]) if self.pin_workers else "not pinned",
+        ))
+
+    def get_pool(self):
+        # the pool is started on first use and shared by field generation and the game sims until close_pool.
+        # every worker gets the slate arrays once, when it starts, instead of them being pickled into every task
+        if self.pool is None:
+            slate_arrays, slate_params = self.build_slate_arrays()
+            if self.pool_backend == "thread":
+                cpu_sets = queue.Queue() if self.pin_workers else None
+            else:
+                cpu_sets = mp.Queue() if self.pin_workers else None
+            if cpu_sets is not None:
+                for cpu_set in self.get_cpu_sets():
+                    cpu_sets.put(cpu_set)
+            if self.pool_backend == "thread":
+                # threads already share this process's memory, and its BLAS, so the limit is set once here
+                shared_arrays.update(slate_arrays)
+                shared_arrays.update(slate_params)
+                limit_blas_threads(self.blas_threads)
+                self.pool = ThreadPool(self.num_workers, initializer=init_worker,
+                                       initargs=(None, None, 0, cpu_sets))
+            else:
+                self.pool_blocks, specs = publish_shared_arrays(slate_arrays)
+                # set the BLAS limit in the environment before the workers start, so spawned workers load their
+                # BLAS with it. forked workers inherit this process's BLAS, which main.py limits before numpy loads,
+                # and threadpoolctl in init_worker if it's installed
+                for var in blas_thread_vars:
+                    os.environ[var] = str(self.blas_threads)
+                self.pool = mp.Pool(self.num_workers, initializer=init_worker,
+                                    initargs=(specs, slate_params, self.blas_threads, cpu_sets))
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for block in self.pool_blocks:
+            block.close()
+            block.unlink()
+        self.pool_blocks = []
+        shared_arrays.clear()
+
+    def build_field_matrix(self):
+        lineups = self.field_lineups.lineups
+        # exact duplicate lineups are collapsed into one row with a count, players are sorted so the
+        # roster slot they were placed in doesn't matter
+        unique_lineups, unique_index, self.lineup_counts = np.unique(
+            np.sort(lineups, axis=1), axis=0, return_inverse=True, return_counts=True
+        )
+        self.field_unique_index = unique_index.ravel()
+        # players that aren't on the slate are stored as -1 and score nothing
+        if np.any(unique_lineups < 0):
+            print("{} field lineups have players with no projection".format(np.count_nonzero(np.any(lineups < 0, axis=1))))
+        self.field_matrix = self.build_lineup_matrix(unique_lineups)
+        print("{} field lineups collapsed into {} unique lineups".format(len(self.field_lineups), len(unique_lineups)))
+
+    def build_lineup_matrix(self, lineups):
+        from scipy.sparse import csr_matrix
+        # sparse lineups x num_players matrix with a 1 for every player in a lineup, so
+        # lineup_matrix @ samples gives every lineup's score in every sim with one product. players are sorted
+        # first so the same lineup always sums its players in the same order and scores exactly the same
+        lineups = np.sort(lineups, axis=1)
+        rows = np.repeat(np.arange(len(lineups)), lineups.shape[1])
+        cols = lineups.ravel()
+        return csr_matrix(
+            (np.ones(np.count_nonzero(cols >= 0), dtype=np.float32), (rows[cols >= 0], cols[cols >= 0])),
+            shape=(len(lineups), len(self.player_dict))
+        )
 
     def calc_gamma(self, mean, sd):
         alpha = (mean / sd) ** 2
@@ -947,81 +1428,94 @@ class CFB_GPP_Simulator:
         return alpha, beta
 
     @staticmethod
-    def run_simulation_for_game(team1_id, team1, team2_id, team2, qb_samples_dict, num_iterations, roster_construction):
-        # Define correlations between positions
-
-        def get_corr_value(player1, player2):
-            # If players are on the same team and have the same position
-            if player1['Team'] == player2['Team'] and player1['Position'][0] == player2['Position'][0]:
-                return -0.25
-
-            if player1['Team'] != player2['Team']:
-                player_2_pos = 'Opp ' + str(player2['Position'][0])
-            else:
-                player_2_pos = player2['Position'][0]
-
-            # Fetch correlation value based on player1's primary position for player2's primary position
-            return player1['Correlations'][player_2_pos]
-
-        def build_covariance_matrix(players):
-            N = len(players)
-            matrix = [[0 for _ in range(N)] for _ in range(N)]
-            corr_matrix = [[0 for _ in range(N)] for _ in range(N)]
-
-            for i in range(N):
-                for j in range(N):
-                    if i == j:
-                        matrix[i][j] = players[i]['StdDev'] ** 2  # Variance on the diagonal
-                        corr_matrix[i][j] = 1
-                    else:
-                        matrix[i][j] = get_corr_value(players[i], players[j]) * players[i]['StdDev'] * players[j][
-                            'StdDev']
-                        corr_matrix[i][j] = get_corr_value(players[i], players[j])
-            return matrix, corr_matrix
-
-        def ensure_positive_semidefinite(matrix):
-            eigs = np.linalg.eigvals(matrix)
-            if np.any(eigs < 0):
-                jitter = abs(min(eigs)) + 1e-6  # a small value
-                matrix += np.eye(len(matrix)) * jitter
-            return matrix
-
-        game = team1 + team2
-        covariance_matrix, corr_matrix = build_covariance_matrix(game)
-        # print(team1_id, team2_id)
-        # print(corr_matrix)
-        corr_matrix = np.array(corr_matrix)
-
-        # Given eigenvalues and eigenvectors from previous code
-        eigenvalues, eigenvectors = np.linalg.eigh(covariance_matrix)
-
-        # Set negative eigenvalues to zero
-        eigenvalues[eigenvalues < 0] = 0
-
-        # Reconstruct the matrix
-        covariance_matrix = eigenvectors.dot(np.diag(eigenvalues)).dot(eigenvectors.T)
+    def get_covariance_factor(covariance_matrix, cache_dir):
+        # the factor only depends on the covariance matrix, so key it by a hash of the matrix. factors are kept
+        # in memory for this process and on disk in cache_dir so re-running the same slate skips factorizing
+        key = hashlib.sha1(np.ascontiguousarray(covariance_matrix).tobytes()).hexdigest()
+        if key in CFB_GPP_Simulator.covariance_factors:
+            return CFB_GPP_Simulator.covariance_factors[key]
+        path = os.path.join(cache_dir, "cov_{}.npy".format(key))
+        if os.path.exists(path):
+            factor = np.load(path)
+        else:
+            # Given eigenvalues and eigenvectors from previous code
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance_matrix)
+
+            # Set negative eigenvalues to zero, the repaired covariance matrix is factor @ factor.T
+            eigenvalues[eigenvalues < 0] = 0
+            factor = eigenvectors * np.sqrt(eigenvalues)
+
+            # write to a temp file first so other workers never load a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                np.save(f, factor)
+            os.replace(tmp_path, path)
+        CFB_GPP_Simulator.covariance_factors[key] = factor
+        return factor
 
-        try:
-            samples = multivariate_normal.rvs(mean=[player['Fpts'] for player in game], cov=covariance_matrix,
-                                              size=num_iterations)
-        except:
-            print(team1_id, team2_id, 'bad matrix')
-
-        player_samples = []
-        for i, player in enumerate(game):
-            if 'QB' in player['Position']:
-                sample = samples[:, i]
-            else:
-                sample = samples[:, i]
-            # if player['Team'] in ['LAR','SEA']:
-            #     print(player['Name'], player['Fpts'], player['StdDev'], sample, np.mean(sample), np.std(sample))
-            player_samples.append(sample)
+    @staticmethod
+    def simulate_game(team1_id, team2_id, game, on_team1, num_iterations, seed, sampler, normals):
+        # runs in a pool worker, game holds the rows of this game's players in the shared slate arrays
+        return CFB_GPP_Simulator.run_simulation_for_game(
+            team1_id,
+            team2_id,
+            shared_arrays["fpts"][game],
+            shared_arrays["stddevs"][game],
+            shared_arrays["position_codes"][game],
+            on_team1,
+            shared_arrays["correlation_table"][game],
+            num_iterations,
+            seed,
+            shared_arrays["cache_dir"],
+            np.dtype(shared_arrays["sim_dtype"]),
+            sampler,
+            normals,
+        )
 
-        temp_fpts_dict = {}
-        # print(team1_id, team2_id, len(game), uniform_samples.T.shape, len(player_samples), covariance_matrix.shape )
+    @staticmethod
+    def draw_standard_normals(rng, num_iterations, num_players, sampler, dtype):
+        # num_iterations x num_players independent standard normals. "antithetic" pairs every draw with its
+        # negation, "sobol" pushes a scrambled Sobol sequence through the inverse normal cdf so the draws cover
+        # the space more evenly than random ones
+        if sampler == "sobol":
+            from scipy.special import ndtri
+            from scipy.stats import qmc
+            with warnings.catch_warnings():
+                # sobol points are only perfectly balanced in powers of 2, other counts are still better than random
+                warnings.simplefilter("ignore", UserWarning)
+                uniforms = qmc.Sobol(d=num_players, scramble=True, seed=rng).random(num_iterations)
+            return ndtri(np.clip(uniforms, 1e-12, 1 - 1e-12)).astype(dtype)
+        if sampler == "antithetic":
+            half = rng.standard_normal(size=((num_iterations + 1) // 2, num_players), dtype=dtype)
+            return np.concatenate((half, -half))[:num_iterations]
+        return rng.standard_normal(size=(num_iterations, num_players), dtype=dtype)
 
-        for i, player in enumerate(game):
-            temp_fpts_dict[player['ID']] = player_samples[i]
+    @staticmethod
+    def run_simulation_for_game(team1_id, team2_id, fpts, stddevs, position_codes, on_team1, correlation_rows,
+                                num_iterations, seed, cache_dir, dtype, sampler="random", normals=None):
+        # fpts, stddevs, position_codes, on_team1 and correlation_rows have one entry per player in the game,
+        # team1 players first. correlation_rows[i] is player i's compiled correlation table row. normals are
+        # the standard normals to use when they were drawn for the whole slate, otherwise they're drawn here
+        num_positions = correlation_rows.shape[1] // 2
+        same_team = on_team1[:, None] == on_team1[None, :]
+        # column of player i's row holding its correlation with player j, 'Opp ' columns for the other team
+        corr_cols = position_codes[None, :] + np.where(same_team, 0, num_positions)
+        corr_matrix = np.take_along_axis(correlation_rows, corr_cols, axis=1)
+        # players on the same team at the same position take touches from each other
+        corr_matrix[same_team & (position_codes[:, None] == position_codes[None, :])] = -0.25
+        np.fill_diagonal(corr_matrix, 1)
+        covariance_matrix = corr_matrix * np.outer(stddevs, stddevs)
+
+        factor = CFB_GPP_Simulator.get_covariance_factor(covariance_matrix, cache_dir)
+        # correlated samples are standard normals through the covariance factor, shifted by the projections
+        rng = np.random.default_rng(seed)
+        if normals is None:
+            z = CFB_GPP_Simulator.draw_standard_normals(rng, num_iterations, len(fpts), sampler, dtype)
+        else:
+            z = normals.astype(dtype, copy=False)
+        # num_iterations x players in the game
+        samples = z @ factor.T.astype(dtype) + fpts.astype(dtype)
 
         # fig, (ax1, ax2, ax3,ax4) = plt.subplots(4, figsize=(15, 25))
         # fig.tight_layout(pad=5.0)
@@ -1064,100 +1558,731 @@ class CFB_GPP_Simulator:
         # plt.savefig(f'output/Team_{team1_id}{team2_id}_Distributions_Correlation.png', bbox_inches='tight')
         # plt.close()
 
-        return temp_fpts_dict
+        return samples
+
+    @staticmethod
+    def rank_field_chunk(fpts_array, lineup_counts, payouts, wins, top10, cashes, roi, squares=None, sim_payouts=None):
+        # fpts_array is (unique lineups, iterations in chunk) and lineup_counts is how many entries
+        # play each unique lineup. running totals are per entry and updated in place. squares, if given, are
+        # running sums of the squared per sim win, top 10 and roi outcomes for standard errors. sim_payouts, if
+        # given, is a (iterations in chunk, unique lineups) array that gets every entry's net payout in every sim
+        num_lineups, num_sims = fpts_array.shape
+        field_size = payouts.field_size
+        cash_line = payouts.cash_line
+        # only the paying places and the top 10 need to be put in order, everyone below them
+        # gets the flat non-paying outcome, so partition those off instead of sorting the whole field.
+        # every unique lineup fills at least one place, so top_k of them always reach the cash line
+        top_k = min(max(cash_line, 10), field_size, num_lineups)
+        top_idx = np.argpartition(fpts_array, num_lineups - top_k, axis=0)[num_lineups - top_k:]
+        top_fpts = np.take_along_axis(fpts_array, top_idx, axis=0)
+        # ranks[i, sim] is the unique lineup finishing i-th best in that sim
+        ranks = np.take_along_axis(top_idx, np.argsort(-top_fpts, axis=0), axis=0)
+        # the copies of a lineup tie, taking places first_place to last_place - 1 between them
+        dupes = lineup_counts[ranks]
+        last_place = np.cumsum(dupes, axis=0)
+        first_place = last_place - dupes
+
+        def place_share(places):
+            # share of each copy in the first `places` places
+            return (np.minimum(last_place, places) - np.minimum(first_place, places)) / dupes
+
+        flat_ranks = ranks.ravel()
+        win_share = place_share(1).ravel()
+        top10_share = place_share(9).ravel()
+        wins += np.bincount(flat_ranks, weights=win_share, minlength=num_lineups)
+        top10 += np.bincount(flat_ranks, weights=top10_share, minlength=num_lineups)
+        cashes += np.bincount(flat_ranks, weights=place_share(cash_line).ravel(), minlength=num_lineups)
+        # tied copies split the prize money for the places they take, looked up by payout band
+        payout = (payouts.cumulative(last_place) - payouts.cumulative(first_place)) / dupes
+        # everybody takes the last place outcome, then the top_k lineups get the difference to their payout
+        roi += payouts.last_place_payout * num_sims
+        roi += np.bincount(flat_ranks, weights=(payout - payouts.last_place_payout).ravel(), minlength=num_lineups)
+        if sim_payouts is not None:
+            sim_payouts[:] = payouts.last_place_payout
+            sim_payouts[np.broadcast_to(np.arange(num_sims), ranks.shape), ranks] = payout
+        if squares is not None:
+            wins_sq, top10_sq, roi_sq = squares
+            wins_sq += np.bincount(flat_ranks, weights=win_share ** 2, minlength=num_lineups)
+            top10_sq += np.bincount(flat_ranks, weights=top10_share ** 2, minlength=num_lineups)
+            roi_sq += payouts.last_place_payout ** 2 * num_sims
+            roi_sq += np.bincount(flat_ranks, weights=(payout ** 2 - payouts.last_place_payout ** 2).ravel(),
+                                  minlength=num_lineups)
+
+    def get_games(self):
+        # (matchup, player rows, which rows are on the first team) for every game. matchups is a set, whose order
+        # changes with python's string hashing from one process to the next, so games are sorted to give every game
+        # the same seed in every run
+        games = []
+        for m in sorted(self.matchups):
+            game = np.array(self.team_indices[m[0]] + self.team_indices[m[1]], dtype=np.int64)
+            games.append((m, game, np.arange(len(game)) < len(self.team_indices[m[0]])))
+        return games
+
+    def get_game_normals(self, num_iterations, seeds, sampler, games):
+        # standard normals drawn for the whole slate at once, split up by game, or None for every game
+        # when each game draws its own
+        if sampler != "sobol":
+            return [None] * len(games)
+        # one sobol point set spanning every player on the slate, split up by game. scrambling a separate
+        # set per game would correlate the games, every game's i-th point would come from the same digits
+        sizes = [len(game) for m, game, on_team1 in games]
+        # the generator gets a fresh seed sequence, sobol spawns from it and would otherwise advance seeds[0]
+        rng = np.random.default_rng(seeds[0].generate_state(4))
+        z = self.draw_standard_normals(rng, num_iterations, sum(sizes), sampler, self.sim_dtype)
+        return np.split(z, np.cumsum(sizes)[:-1], axis=1)
+
+    def simulate_games(self, num_iterations, seeds, sampler=None, normals=None):
+        # runs every game's sim on the pool with one seed per game, returns the num_players x num_iterations
+        # matrix of simulated fpts, rows follow player_dict order. normals, if given, are every game's standard
+        # normals instead of fresh draws
+        sampler = sampler or self.sim_sampler
+        games = self.get_games()
+        if normals is None:
+            normals = self.get_game_normals(num_iterations, seeds, sampler, games)
+        game_simulation_params = []
+        simulated_games = []
+        for (m, game, on_team1), seed, game_normals in zip(games, seeds, normals):
+            # games that have been played keep their actual scores, every game keeps its own seed either way
+            if self.is_game_locked(game):
+                continue
+            game_simulation_params.append((m[0], m[1], game, on_team1, num_iterations, seed, sampler, game_normals))
+            simulated_games.append(game)
+        results = self.get_pool().starmap(self.simulate_game, game_simulation_params, chunksize=self.pool_chunksize)
+        sample_matrix = np.zeros(shape=(len(self.player_table), num_iterations), dtype=self.sim_dtype)
+        for game, samples in zip(simulated_games, results):
+            sample_matrix[game] = samples.T
+        if self.locked_fpts is not None:
+            locked = ~np.isnan(self.locked_fpts)
+            sample_matrix[locked] = self.locked_fpts[locked, None]
+        return sample_matrix
+
+    def sim_chunks(self, num_iterations):
+        # slices of at most sim_chunk_size sims covering num_iterations sims
+        chunk_size = max(1, min(self.sim_chunk_size, num_iterations))
+        for chunk_start in range(0, num_iterations, chunk_size):
+            yield slice(chunk_start, min(chunk_start + chunk_size, num_iterations))
+
+    def score_chunks(self, sample_matrix, scores=None):
+        # unique lineup fpts for the sims in sample_matrix, one chunk of sims at a time. scores, if given, is a
+        # unique lineups x sims array that gets every lineup's score
+        for chunk in self.sim_chunks(sample_matrix.shape[1]):
+            fpts_array = self.field_matrix @ sample_matrix[:, chunk]
+            if scores is not None:
+                scores[:, chunk] = fpts_array
+            yield chunk, fpts_array
+
+    def rank_samples(self, sample_matrix, totals, squares=None, scores=None, sim_payouts=None):
+        # adds the results of every sim in sample_matrix to the per unique lineup running totals
+        self.rank_scores(self.score_chunks(sample_matrix, scores), totals, squares, sim_payouts)
+
+    def rank_scores(self, score_chunks, totals, squares=None, sim_payouts=None):
+        # adds the results of every (sim slice, unique lineup fpts) chunk to the per unique lineup running totals.
+        # sim_payouts, if given, is a sims x unique lineups array that gets every lineup's payout
+        wins, top10, cashes, roi = totals
+        for chunk, fpts_array in score_chunks:
+            self.rank_field_chunk(fpts_array, self.lineup_counts, self.payouts, wins, top10, cashes, roi, squares,
+                                  None if sim_payouts is None else sim_payouts[chunk])
+
+    def run_batch(self, num_iterations, seeds, totals, squares=None):
+        # simulates and ranks one batch of sims. incremental mode keeps the batch's seeds, samples and unique
+        # lineup scores so update_players can redo just the games that change
+        sample_matrix = self.simulate_games(num_iterations, seeds)
+        scores = None
+        if self.incremental_sim:
+            scores = np.zeros(shape=(len(self.lineup_counts), num_iterations), dtype=self.sim_dtype)
+            self.sim_batches.append(
+                {"seeds": seeds, "sampler": self.sim_sampler, "samples": sample_matrix, "scores": scores}
+            )
+        self.rank_samples(sample_matrix, totals, squares, scores, self.next_sim_payouts(num_iterations))
+
+    def allocate_sim_payouts(self):
+        # room for every unique lineup's payout in every sim, in memory or in a file in the cache dir
+        shape = (self.num_iterations, len(self.lineup_counts))
+        self.sim_payouts_filled = 0
+        if self.portfolio_memmap:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, "{}_sim_payouts.npy".format(self.site))
+            self.sim_payouts = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+        else:
+            self.sim_payouts = np.zeros(shape=shape, dtype=np.float32)
+
+    def next_sim_payouts(self, num_iterations):
+        # the rows of sim_payouts for the next num_iterations sims, or None when they aren't kept
+        if self.sim_payouts is None:
+            return None
+        start = self.sim_payouts_filled
+        self.sim_payouts_filled += num_iterations
+        return self.sim_payouts[start:self.sim_payouts_filled]
+
+    def get_confidence_intervals(self, totals, squares, num_iterations):
+        # half widths of the 95% confidence intervals of every unique lineup's win%, top 10% and ROI%
+        wins, top10, cashes, roi = totals
+        stats = [("win", wins, squares[0], 100), ("top10", top10, squares[1], 100)]
+        if self.use_contest_data:
+            stats.append(("roi", roi, squares[2], 100 / self.entry_fee))
+        half_widths = {}
+        for name, total, square, scale in stats:
+            mean = total / num_iterations
+            variance = np.maximum(square / num_iterations - mean ** 2, 0) * num_iterations / max(num_iterations - 1, 1)
+            half_widths[name] = 1.96 * np.sqrt(variance / num_iterations) * scale
+        return half_widths
+
+    def run_adaptive_simulation(self, seeds, totals, start_time):
+        # simulates in batches until the top lineups' confidence intervals are within adaptive_precision, or the
+        # iteration (num_iterations) or time budget runs out. returns the number of iterations used
+        squares = [np.zeros(len(self.lineup_counts)) for _ in range(3)]
+        wins, top10, cashes, roi = totals
+        iterations = 0
+        while iterations < self.num_iterations:
+            batch_size = min(self.adaptive_batch_size, self.num_iterations - iterations)
+            # the first batch uses the game seeds as they are, so one big batch matches a fixed run.
+            # later batches draw fresh streams from them
+            batch_seeds = seeds if iterations == 0 else [seed.spawn(1)[0] for seed in seeds]
+            self.run_batch(batch_size, batch_seeds, totals, squares)
+            iterations += batch_size
+            half_widths = self.get_confidence_intervals(totals, squares, iterations)
+            top_n = np.argsort(-(roi if self.use_contest_data else wins))[:self.adaptive_top_n]
+            widest = {name: half_width[top_n].max() for name, half_width in half_widths.items()}
+            print("{} simulations, widest 95% CI in the top {}: {}".format(
+                iterations, len(top_n), ", ".join("{} +/-{:.2f}%".format(k, v) for k, v in widest.items())
+            ))
+            targets = {name: target for name, target in self.adaptive_precision.items() if target > 0 and name in widest}
+            if len(targets) > 0 and all(widest[name] <= target for name, target in targets.items()):
+                print("Target precision reached after {} simulations".format(iterations))
+                break
+            if self.adaptive_time_budget and time.time() - start_time >= self.adaptive_time_budget:
+                print("Time budget reached after {} simulations".format(iterations))
+                break
+        # every copy of a unique lineup gets its intervals
+        self.confidence_intervals = {name: half_width[self.field_unique_index] for name, half_width in
+                                     half_widths.items()}
+        return iterations
+
+    def benchmark_samplers(self, repeats=10, samplers=("random", "antithetic", "sobol")):
+        # re-runs the sim repeats times with every sampler on fresh seeds and measures how much each lineup's
+        # win%, top 10% and ROI move between repeats. a sampler's effective sample size gain is the random
+        # sampler's variance over its own, i.e. how many random sims each of its sims is worth
+        if self.field_matrix is None:
+            self.build_field_matrix()
+        names = ["win", "top10", "roi"] if self.use_contest_data else ["win", "top10"]
+        rows = {"win": 0, "top10": 1, "roi": 3}
+        root_seed = np.random.SeedSequence(self.seed)
+        variances = {}
+        print("Benchmarking samplers: {} repeats of {} simulations".format(repeats, self.num_iterations))
+        for sampler in samplers:
+            start_time = time.time()
+            estimates = []
+            for repeat in range(repeats):
+                totals = [np.zeros(len(self.lineup_counts)) for _ in range(4)]
+                seeds = root_seed.spawn(1)[0].spawn(len(self.matchups))
+                self.rank_samples(self.simulate_games(self.num_iterations, seeds, sampler), totals)
+                estimates.append(np.array(totals) / self.num_iterations)
+            # total variance over all lineups of every stat's estimate
+            variances[sampler] = np.var(estimates, axis=0, ddof=1).sum(axis=1)
+            print("{:<12} {:.2f} seconds per run".format(sampler, (time.time() - start_time) / repeats))
+        print("{:<12} {}".format("sampler", " ".join("{:>14}".format(name + " ESS gain") for name in names)))
+        for sampler in samplers:
+            gains = variances["random"] / np.maximum(variances[sampler], 1e-300)
+            print("{:<12} {}".format(sampler, " ".join("{:>13.2f}x".format(gains[rows[name]]) for name in names)))
+        return variances
 
     def run_tournament_simulation(self):
         print("Running " + str(self.num_iterations) + " simulations")
-        for f in self.field_lineups:
-            if len(self.field_lineups[f]['Lineup']) != 9:
-                print('bad lineup', f, self.field_lineups[f])
+        for f in np.where(np.any(self.field_lineups.lineups < 0, axis=1))[0]:
+            print('bad lineup', f, self.field_lineups[f])
 
         start_time = time.time()
-        temp_fpts_dict = {}
-        qb_samples_dict = {}  # keep track of already simmed quarterbacks
-        size = self.num_iterations
-        game_simulation_params = []
-        for m in self.matchups:
-            game_simulation_params.append((m[0], self.teams_dict[m[0]], m[1], self.teams_dict[m[1]], qb_samples_dict,
-                                           self.num_iterations, self.roster_construction))
-        with mp.Pool() as pool:
-            results = pool.starmap(self.run_simulation_for_game, game_simulation_params)
-
-        for res in results:
-            temp_fpts_dict.update(res)
-
-        # generate arrays for every sim result for each player in the lineup and sum
-        fpts_array = np.zeros(shape=(self.field_size, self.num_iterations))
-        # converting payout structure into an np friendly format, could probably just do this in the load contest function
-        payout_array = np.array(list(self.payout_structure.values()))
-        # subtract entry fee
-        payout_array = payout_array - self.entry_fee
-        l_array = np.full(shape=self.field_size - len(payout_array), fill_value=-self.entry_fee)
-        payout_array = np.concatenate((payout_array, l_array))
-        for index, values in self.field_lineups.items():
-            try:
-                fpts_sim = sum([temp_fpts_dict[player] for player in values["Lineup"]])
-            except KeyError:
-                for player in values["Lineup"]:
-                    if player not in temp_fpts_dict.keys():
-                        for k, v in self.player_dict.items():
-                            if v['ID'] == player:
-                                print(k, v)
-                # print('cant find player in sim dict', values["Lineup"], temp_fpts_dict.keys())
-            # store lineup fpts sum in 2d np array where index (row) corresponds to index of field_lineups and columns are the fpts from each sim
-            fpts_array[index] = fpts_sim
-        ranks = np.argsort(fpts_array, axis=0)[::-1]
-        # count wins, top 10s vectorized
-        wins, win_counts = np.unique(ranks[0, :], return_counts=True)
-        t10, t10_counts = np.unique(ranks[0:9:], return_counts=True)
-        roi = payout_array[np.argsort(ranks, axis=0)].sum(axis=1)
-        # summing up ach lineup, probably a way to v)ectorize this too (maybe just turning the field dict into an array too)
-        for idx in self.field_lineups.keys():
-            # Winning
-            if idx in wins:
-                self.field_lineups[idx]["Wins"] += win_counts[np.where(wins == idx)][0]
-            # Top 10
-            if idx in t10:
-                self.field_lineups[idx]["Top10"] += t10_counts[np.where(t10 == idx)][0]
-            # can't figure out how to get roi for each lineup index without iterating and iterating is slow
-            if self.use_contest_data:
-                self.field_lineups[idx]["ROI"] += roi[idx]
+        if self.field_matrix is None:
+            self.build_field_matrix()
+        # running totals per copy of each unique lineup, so only one chunk of sims has to be ranked at a time
+        num_lineups = len(self.lineup_counts)
+        totals = [np.zeros(num_lineups) for _ in range(4)]
+        self.sim_batches = []
+        if self.portfolio_size > 0 and self.use_contest_data:
+            self.allocate_sim_payouts()
+        elif self.portfolio_size > 0:
+            print("portfolio selection needs contest payouts, run with cid")
+        # independent random streams for every game
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.matchups))
+        if self.adaptive_sim:
+            # output reports the sims that were actually run
+            self.num_iterations = self.run_adaptive_simulation(seeds, totals, start_time)
+        else:
+            self.run_batch(self.num_iterations, seeds, totals)
+        if self.sim_payouts is not None:
+            # adaptive mode may have stopped early
+            self.sim_payouts = self.sim_payouts[:self.sim_payouts_filled]
+        self.store_results(totals)
+        if self.incremental_sim:
+            self.player_changes = {}
+            self.save_sim_batches()
         end_time = time.time()
         diff = end_time - start_time
         print(str(self.num_iterations) + " tournament simulations finished in " + str(diff) + "seconds. Outputting.")
 
+    def store_results(self, totals):
+        wins, top10, cashes, roi = totals
+        # every copy of a unique lineup gets its results
+        self.field_lineups.wins += wins[self.field_unique_index]
+        self.field_lineups.top10 += top10[self.field_unique_index]
+        self.field_lineups.cashes += cashes[self.field_unique_index]
+        if self.use_contest_data:
+            self.field_lineups.roi += roi[self.field_unique_index]
+
+    def select_portfolio(self, size=None):
+        # greedily picks the unique lineups that add the most expected return to the portfolio, from the per sim
+        # payouts kept by the last sim. a lineup's winnings in a sim count portfolio_overlap_discount times less for
+        # every earlier pick that won in that sim too, so picks that win in the same sims as the others fall back.
+        # losses always count in full. returns the picked unique lineups and each one's marginal expected return
+        sim_payouts = self.sim_payouts
+        num_sims, num_lineups = sim_payouts.shape
+        size = min(size or self.portfolio_size, num_lineups)
+        chunk_size = max(1, self.sim_chunk_size)
+        # expected payout of every lineup, a chunk of sims at a time so a memmap is never all read in at once
+        gains = np.zeros(num_lineups)
+        for chunk_start in range(0, num_sims, chunk_size):
+            gains += sim_payouts[chunk_start:chunk_start + chunk_size].sum(axis=0, dtype=np.float64)
+        gains /= num_sims
+        # how much winnings still count in every sim
+        weights = np.ones(num_sims)
+        available = np.ones(num_lineups, dtype=bool)
+        picks = []
+        pick_gains = []
+        for _ in range(size):
+            pick = int(np.argmax(np.where(available, gains, -np.inf)))
+            picks.append(pick)
+            pick_gains.append(gains[pick])
+            available[pick] = False
+            won = np.nonzero(sim_payouts[:, pick] > 0)[0]
+            # every other lineup's gain loses the part of its winnings in those sims that no longer counts
+            drop = weights[won] * (1 - self.portfolio_overlap_discount)
+            weights[won] -= drop
+            for chunk_start in range(0, len(won), chunk_size):
+                chunk = won[chunk_start:chunk_start + chunk_size]
+                gains -= drop[chunk_start:chunk_start + chunk_size] @ np.maximum(sim_payouts[chunk], 0) / num_sims
+        return np.array(picks, dtype=np.int64), np.array(pick_gains)
+
+    def output_portfolio(self, picks, pick_gains):
+        # one row per picked lineup in pick order, with its own ROI and what it added to the portfolio
+        table = self.player_table
+        returns = np.zeros(len(self.sim_payouts))
+        for pick in picks:
+            returns += self.sim_payouts[:, pick]
+        print("Portfolio of {} lineups: expected return ${}, ROI {}%, profits in {}% of sims".format(
+            len(picks), round(returns.mean(), 2), round(returns.mean() / (self.entry_fee * len(picks)) * 100, 2),
+            round(np.mean(returns > 0) * 100, 2)
+        ))
+        # a field lineup that plays each unique lineup
+        first_lineup = np.unique(self.field_unique_index, return_index=True)[1]
+        header = ["QB", "RB", "RB", "WR", "WR", "WR", "FLEX", "S-FLEX", "Lineup Type", "Fpts Proj", "Salary", "ROI%",
+                  "Marginal Return", "Field Copies"]
+        out_path = os.path.join(
+            os.path.dirname(__file__),
+            "../output/{}_gpp_sim_portfolio_{}_{}.csv".format(self.site, self.field_size, self.num_iterations),
+        )
+        with open(out_path, "w") as f:
+            f.write(",".join(header) + "\n")
+            for pick, gain in zip(picks, pick_gains):
+                index = first_lineup[pick]
+                lineup = self.field_lineups.lineups[index]
+                players = self.format_lineup_players(lineup)
+                values = [
+                    FieldLineups.lineup_types[self.field_lineups.types[index]],
+                    round(float(table.fpts[lineup].sum()), 2),
+                    table.salary[lineup].sum(),
+                    "{}%".format(round(self.field_lineups.roi[index] / self.entry_fee / self.num_iterations * 100, 2)),
+                    "${}".format(round(gain, 2)),
+                    self.lineup_counts[pick],
+                ]
+                f.write(",".join(players + [str(v) for v in values]) + "\n")
+
+    def update_players(self, changes):
+        # changes maps player IDs to their new "Fpts", "StdDev" and/or "Ownership". games with a player whose
+        # projection or stddev changed are re-simulated with their original seeds (so nothing else moves), the
+        # lineups with players in those games are re-scored and the whole field is re-ranked from the kept
+        # scores. players in games that have locked since the sim (late swap) get their actual scores. needs
+        # incremental_sim and a finished run_tournament_simulation, or a sim from load_sim_batches
+        if len(self.sim_batches) == 0:
+            print("update_players needs incremental_sim turned on and a finished simulation")
+            return
+        start_time = time.time()
+        table = self.player_table
+        changed_teams = self.apply_player_changes(changes)
+        # the pool workers' copies of the slate arrays are out of date now, the next pool gets fresh ones
+        self.close_pool()
+
+        # the few changed games are quicker to run here than to start a new pool for
+        games = self.get_games()
+        changed_games = [i for i, (m, game, on_team1) in enumerate(games)
+                         if (m[0] in changed_teams or m[1] in changed_teams) and not self.is_game_locked(game)]
+        # players in games locked since the samples were drawn, whose samples aren't their actual scores yet
+        locked_fpts = self.locked_fpts if self.locked_fpts is not None else np.full(len(table), np.nan)
+        locked_rows = np.where(~np.isnan(locked_fpts))[0]
+        newly_locked = np.zeros(len(locked_rows), dtype=bool)
+        for batch in self.sim_batches:
+            actual = locked_fpts[locked_rows, None].astype(batch["samples"].dtype)
+            newly_locked |= np.any(batch["samples"][locked_rows] != actual, axis=1)
+        locked_rows = locked_rows[newly_locked]
+        changed_rows = np.concatenate([games[i][1] for i in changed_games] + [locked_rows])
+        # unique lineups with a player in a re-simulated or newly locked game
+        rescored = np.unique(self.field_matrix[:, changed_rows].nonzero()[0])
+        for batch in self.sim_batches:
+            num_iterations = batch["samples"].shape[1]
+            normals = self.get_game_normals(num_iterations, batch["seeds"], batch["sampler"], games)
+            for i in changed_games:
+                m, game, on_team1 = games[i]
+                samples = self.run_simulation_for_game(
+                    m[0], m[1], table.fpts[game], table.stddev[game], self.position_codes[game], on_team1,
+                    self.correlation_table[game], num_iterations, batch["seeds"][i], self.cache_dir, self.sim_dtype,
+                    batch["sampler"], normals[i],
+                )
+                batch["samples"][game] = samples.T
+            batch["samples"][locked_rows] = locked_fpts[locked_rows, None]
+            batch["scores"][rescored] = self.field_matrix[rescored] @ batch["samples"]
+
+        totals = [np.zeros(len(self.lineup_counts)) for _ in range(4)]
+        squares = [np.zeros(len(self.lineup_counts)) for _ in range(3)]
+        self.sim_payouts_filled = 0
+        for batch in self.sim_batches:
+            num_iterations = batch["scores"].shape[1]
+            self.rank_scores(((chunk, batch["scores"][:, chunk]) for chunk in self.sim_chunks(num_iterations)),
+                             totals, squares, self.next_sim_payouts(num_iterations))
+        self.field_lineups.reset_results()
+        self.store_results(totals)
+        if self.confidence_intervals is not None:
+            self.confidence_intervals = {
+                name: half_width[self.field_unique_index]
+                for name, half_width in self.get_confidence_intervals(totals, squares, self.num_iterations).items()
+            }
+        print("{} players updated, {} games re-simulated, {} players locked and {} of {} unique lineups re-scored in {} "
+              "seconds".format(len(changes), len(changed_games), len(locked_rows), len(rescored), len(self.lineup_counts),
+                               time.time() - start_time))
+        self.save_sim_batches()
+
+    def apply_player_changes(self, changes):
+        # puts update_players changes into player_dict and the player table, and remembers them so a reloaded sim
+        # gets them back. returns the teams with a changed projection or stddev
+        table = self.player_table
+        players = list(self.player_dict.values())
+        changed_teams = set()
+        for player_id, values in changes.items():
+            row = table.index.get(str(player_id))
+            if row is None:
+                print("{} is not on the slate".format(player_id))
+                continue
+            for key, column in [("Fpts", table.fpts), ("StdDev", table.stddev), ("Ownership", table.ownership)]:
+                if key in values:
+                    players[row][key] = float(values[key])
+                    column[row] = players[row][key]
+            if "Fpts" in values or "StdDev" in values:
+                changed_teams.add(table.teams[row])
+            self.player_changes.setdefault(str(player_id), {}).update(values)
+        return changed_teams
+
+    def get_sim_cache_path(self):
+        # the last incremental sim of this slate and field size. only the slate's files go into the key, so
+        # settings can change between the sim and an update (like turning on late swap at lock)
+        return os.path.join(self.cache_dir, "sim_{}_{}.npz".format(self.get_slate_key(self.slate_files), self.field_size))
+
+    def save_sim_batches(self):
+        # keeps the field, every batch's seeds, samples and scores, and the player changes applied so far in the
+        # cache dir, so update_players can run in a later invocation (the update process)
+        saved = {
+            "lineups": self.field_lineups.lineups,
+            "types": self.field_lineups.types,
+            "num_iterations": np.array(self.num_iterations),
+            "adaptive": np.array(self.confidence_intervals is not None),
+            "player_changes": np.array(json.dumps(self.player_changes)),
+            "num_batches": np.array(len(self.sim_batches)),
+        }
+        for i, batch in enumerate(self.sim_batches):
+            saved["entropy_{}".format(i)] = np.array(str(batch["seeds"][0].entropy))
+            saved["spawn_keys_{}".format(i)] = np.array([seed.spawn_key for seed in batch["seeds"]])
+            saved["sampler_{}".format(i)] = np.array(batch["sampler"])
+            saved["samples_{}".format(i)] = batch["samples"]
+            saved["scores_{}".format(i)] = batch["scores"]
+        path = self.get_sim_cache_path()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **saved)
+        os.replace(tmp_path, path)
+
+    def load_sim_batches(self):
+        # picks up the sim saved by save_sim_batches, returns False when this slate and field size have none
+        path = self.get_sim_cache_path()
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as saved:
+            self.field_lineups = FieldLineups(self.player_table.ids, len(self.roster_construction))
+            self.field_lineups.append(saved["lineups"], saved["types"])
+            self.num_iterations = int(saved["num_iterations"])
+            self.confidence_intervals = {} if bool(saved["adaptive"]) else None
+            self.player_changes = {}
+            # the saved samples already have these changes in them
+            self.apply_player_changes(json.loads(saved["player_changes"].item()))
+            self.sim_batches = []
+            for i in range(int(saved["num_batches"])):
+                entropy = int(saved["entropy_{}".format(i)].item())
+                seeds = [np.random.SeedSequence(entropy, spawn_key=tuple(key))
+                         for key in saved["spawn_keys_{}".format(i)].tolist()]
+                self.sim_batches.append({
+                    "seeds": seeds,
+                    "sampler": saved["sampler_{}".format(i)].item(),
+                    "samples": saved["samples_{}".format(i)],
+                    "scores": saved["scores_{}".format(i)],
+                })
+        self.build_field_matrix()
+        # the per sim payouts aren't saved, update_players re-ranks every batch and fills them in again
+        if self.portfolio_size > 0 and self.use_contest_data:
+            self.allocate_sim_payouts()
+        print("Loaded {} simulations of {} field lineups from {}".format(
+            self.num_iterations, len(self.field_lineups), os.path.basename(path)))
+        return True
+
+
+    def run_scenarios(self, scenarios):
+        # scenarios maps a scenario name to player changes in update_players' format, {player_id: {"Fpts": ..,
+        # "StdDev": ..}}. the standard normals are drawn once and every scenario puts its own projections, stddevs
+        # and covariance factors on top of them (common random numbers), so the differences between scenarios
+        # come from the changes and not from fresh randomness. the current projections are the "base" scenario.
+        # returns {name: totals} and writes a side by side comparison of every lineup's win% and ROI
+        print("Running {} scenarios on {} simulations".format(len(scenarios), self.num_iterations))
+        start_time = time.time()
+        if self.field_matrix is None:
+            self.build_field_matrix()
+        table = self.player_table
+        games = self.get_games()
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.matchups))
+        normals = self.get_game_normals(self.num_iterations, seeds, self.sim_sampler, games)
+        if self.sim_sampler != "sobol":
+            # the same draws each game would make for itself from its seed
+            normals = [
+                self.draw_standard_normals(np.random.default_rng(seed), self.num_iterations, len(game),
+                                           self.sim_sampler, self.sim_dtype)
+                for (m, game, on_team1), seed in zip(games, seeds)
+            ]
+        base_samples = self.simulate_games(self.num_iterations, seeds, normals=normals)
+        results = {}
+        for name, changes in [("base", {})] + list(scenarios.items()):
+            fpts = table.fpts.copy()
+            stddevs = table.stddev.copy()
+            changed_teams = set()
+            for player_id, values in changes.items():
+                row = table.index.get(str(player_id))
+                if row is None:
+                    print("{} is not on the slate".format(player_id))
+                    continue
+                fpts[row] = float(values.get("Fpts", fpts[row]))
+                stddevs[row] = float(values.get("StdDev", stddevs[row]))
+                changed_teams.add(table.teams[row])
+            # only games with a changed player need new samples, the rest are the base samples
+            samples = base_samples
+            if len(changed_teams) > 0:
+                samples = base_samples.copy()
+            for i, (m, game, on_team1) in enumerate(games):
+                if (m[0] in changed_teams or m[1] in changed_teams) and not self.is_game_locked(game):
+                    samples[game] = self.run_simulation_for_game(
+                        m[0], m[1], fpts[game], stddevs[game], self.position_codes[game], on_team1,
+                        self.correlation_table[game], self.num_iterations, seeds[i], self.cache_dir, self.sim_dtype,
+                        self.sim_sampler, normals[i],
+                    ).T
+            totals = [np.zeros(len(self.lineup_counts)) for _ in range(4)]
+            self.rank_samples(samples, totals)
+            results[name] = totals
+        self.output_scenarios(results)
+        print("{} scenarios finished in {} seconds".format(len(scenarios), time.time() - start_time))
+        return results
+
+    def format_lineup_players(self, lineup):
+        # a lineup's players as the lineup output writes them, "name (id)" on dk and "name:id" on fd, in roster
+        # order. S-FLEX is stored first but written last
+        table = self.player_table
+        player_format = "{} ({})" if self.site == "dk" else "{}:{}"
+        return [
+            player_format.format(table.names[p].replace("#", "-"), table.ids[p]) for p in list(lineup[1:]) + [lineup[0]]
+        ]
+
+    def output_scenarios(self, results):
+        # one row per field lineup with every scenario's win% and ROI% next to its change from the base scenario
+        stats = [("Win %", 0, 100 / self.num_iterations)]
+        if self.use_contest_data:
+            stats.append(("ROI%", 3, 100 / self.entry_fee / self.num_iterations))
+        columns = []
+        header = ["QB", "RB", "RB", "WR", "WR", "WR", "FLEX", "S-FLEX", "Lineup Type"]
+        for name in results:
+            for stat, total, scale in stats:
+                columns.append(np.round(results[name][total][self.field_unique_index] * scale, 2))
+                header.append("{} {}".format(name, stat))
+                if name != "base":
+                    base = results["base"][total][self.field_unique_index] * scale
+                    columns.append(np.round(results[name][total][self.field_unique_index] * scale - base, 2))
+                    header.append("{} {} Delta".format(name, stat))
+        out_path = os.path.join(
+            os.path.dirname(__file__),
+            "../output/{}_gpp_sim_scenarios_{}_{}.csv".format(self.site, self.field_size, self.num_iterations),
+        )
+        with open(out_path, "w") as f:
+            f.write(",".join(header) + "\n")
+            for index, lineup in enumerate(self.field_lineups.lineups):
+                players = self.format_lineup_players(lineup)
+                lu_type = FieldLineups.lineup_types[self.field_lineups.types[index]]
+                values = ["{}%".format(column[index]) for column in columns]
+                f.write(",".join(players + [lu_type] + values) + "\n")
+
+    @staticmethod
+    def place_entries(scores, counts, num_entries):
+        # scores is (lineups, sims) with our entries as the last num_entries rows, counts is how many entries play
+        # each row. returns the (first, last) places every one of our entries ties for in every sim, 0 indexed with
+        # last exclusive. each sim's scores are sorted once and our entries are looked up in them, so the rest of
+        # the field is never ranked
+        num_lineups, num_sims = scores.shape
+        order = np.argsort(scores, axis=0)
+        sorted_scores = np.take_along_axis(scores, order, axis=0)
+        # entries at or below each sorted position, with a leading 0
+        below = np.zeros(shape=(num_lineups + 1, num_sims), dtype=np.int64)
+        np.cumsum(counts[order], axis=0, out=below[1:])
+        total = below[-1]
+        entry_scores = scores[num_lineups - num_entries:]
+        first_place = np.zeros(shape=entry_scores.shape, dtype=np.int64)
+        last_place = np.zeros(shape=entry_scores.shape, dtype=np.int64)
+        for sim in range(num_sims):
+            column = sorted_scores[:, sim]
+            lower = np.searchsorted(column, entry_scores[:, sim], side="left")
+            upper = np.searchsorted(column, entry_scores[:, sim], side="right")
+            # everyone scoring more finishes ahead, everyone with the same score shares the places after them
+            first_place[:, sim] = total[sim] - below[upper, sim]
+            last_place[:, sim] = total[sim] - below[lower, sim]
+        return first_place, last_place
+
+    def evaluate_entries(self):
+        # simulates the slate and ranks only our entries (load_entries) against the field, instead of every field
+        # lineup. returns per entry wins, top 10s, cashes, net payout and finishing place summed over every sim
+        print("Evaluating {} entries over {} simulations".format(len(self.entries), self.num_iterations))
+        start_time = time.time()
+        if self.field_matrix is None:
+            self.build_field_matrix()
+        entry_matrix = self.build_lineup_matrix(self.entries)
+        num_entries = len(self.entries)
+        counts = np.concatenate((self.lineup_counts, np.ones(num_entries, dtype=self.lineup_counts.dtype)))
+        totals = [np.zeros(num_entries) for _ in range(5)]
+        wins, top10, cashes, roi, places = totals
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.matchups))
+        sample_matrix = self.simulate_games(self.num_iterations, seeds)
+        chunk_size = max(1, min(self.sim_chunk_size, self.num_iterations))
+        for chunk_start in range(0, self.num_iterations, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, self.num_iterations)
+            samples = sample_matrix[:, chunk_start:chunk_end]
+            scores = np.vstack((self.field_matrix @ samples, entry_matrix @ samples))
+            first_place, last_place = self.place_entries(scores, counts, num_entries)
+            dupes = last_place - first_place
+
+            def place_share(num_places):
+                # share of each entry in the first num_places places
+                return (np.minimum(last_place, num_places) - np.minimum(first_place, num_places)) / dupes
+
+            # same outcomes as rank_field_chunk, tied entries split the places they take
+            wins += place_share(1).sum(axis=1)
+            top10 += place_share(9).sum(axis=1)
+            cashes += place_share(self.payouts.cash_line).sum(axis=1)
+            roi += ((self.payouts.cumulative(last_place) - self.payouts.cumulative(first_place)) / dupes).sum(axis=1)
+            places += ((first_place + last_place - 1) / 2 + 1).sum(axis=1)
+        print("{} entries evaluated in {} seconds".format(num_entries, time.time() - start_time))
+        return totals
+
+    def output_entries(self, totals):
+        # one row per entry with its simulated outcomes
+        wins, top10, cashes, roi, places = [total / self.num_iterations for total in totals]
+        table = self.player_table
+        header = ["QB", "RB", "RB", "WR", "WR", "WR", "FLEX", "S-FLEX", "Fpts Proj", "Salary", "Win %", "Top 10%",
+                  "Cash %", "Avg Finish"]
+        if self.use_contest_data:
+            header += ["ROI%", "Avg Return"]
+        out_path = os.path.join(
+            os.path.dirname(__file__),
+            "../output/{}_gpp_sim_entries_{}_{}.csv".format(self.site, self.field_size, self.num_iterations),
+        )
+        with open(out_path, "w") as f:
+            f.write(",".join(header) + "\n")
+            for i, lineup in enumerate(self.entries):
+                players = self.format_lineup_players(lineup)
+                values = [
+                    round(float(table.fpts[lineup].sum()), 2),
+                    table.salary[lineup].sum(),
+                    "{}%".format(round(wins[i] * 100, 2)),
+                    "{}%".format(round(top10[i] * 100, 2)),
+                    "{}%".format(round(cashes[i] * 100, 2)),
+                    round(places[i], 1),
+                ]
+                if self.use_contest_data:
+                    values += ["{}%".format(round(roi[i] / self.entry_fee * 100, 2)), "${}".format(round(roi[i], 2))]
+                f.write(",".join(players + [str(v) for v in values]) + "\n")
+
+    def run_contests(self, contest_paths):
+        # simulates one slate for several contests. contest_paths are contest structure files like
+        # contest_structure.csv, each with its own payouts, field size and entry fee. the field is generated once
+        # for the biggest contest and every contest plays a random subset of it, all ranked against the same
+        # player samples. writes the usual lineup and exposure output for every contest
+        contests = []
+        for path in contest_paths:
+            payouts = self.read_contest_structure(path)
+            contests.append((os.path.splitext(os.path.basename(path))[0], payouts))
+            print("{}: {} entries, ${} entry fee".format(contests[-1][0], payouts.field_size, payouts.entry_fee))
+        self.use_contest_data = True
+        self.field_size = max(payouts.field_size for name, payouts in contests)
+        self.generate_field_lineups()
+        lineups = self.field_lineups.lineups.copy()
+        types = self.field_lineups.types.copy()
+
+        start_time = time.time()
+        print("Running " + str(self.num_iterations) + " simulations for {} contests".format(len(contests)))
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.matchups))
+        sample_matrix = self.simulate_games(self.num_iterations, seeds)
+        rng = np.random.default_rng(self.seed)
+        for name, payouts in contests:
+            self.contest_name = name
+            self.payouts = payouts
+            self.field_size = payouts.field_size
+            self.entry_fee = payouts.entry_fee
+            field = np.sort(rng.choice(len(lineups), size=min(self.field_size, len(lineups)), replace=False))
+            self.field_lineups = FieldLineups(self.player_table.ids, len(self.roster_construction))
+            self.field_lineups.append(lineups[field], types[field])
+            self.build_field_matrix()
+            totals = [np.zeros(len(self.lineup_counts)) for _ in range(4)]
+            self.rank_samples(sample_matrix, totals)
+            self.store_results(totals)
+            roi = self.field_lineups.roi / self.entry_fee / self.num_iterations * 100
+            print("{}: best ROI {}%, average ROI {}%".format(name, round(roi.max(), 2), round(roi.mean(), 2)))
+            self.output()
+        print("{} contests simulated in {} seconds".format(len(contests), time.time() - start_time))
+
+    def get_contest_suffix(self):
+        # output files of a multi contest run are told apart by contest
+        return "" if self.contest_name is None else "_" + self.contest_name
+
     def output(self):
         unique = {}
-        for index, x in self.field_lineups.items():
+        table = self.player_table
+        field = self.field_lineups
+        for index, lineup in enumerate(field.lineups):
             # if index == 0:
-            #    print(x)
-            lu_type = x["Type"]
-            salary = 0
-            fpts_p = 0
-            ceil_p = 0
-            own_p = []
-            lu_names = []
+            #    print(field[index])
+            lu_type = FieldLineups.lineup_types[field.types[index]]
+            x = {"Lineup": table.ids[lineup], "Wins": field.wins[index], "Top10": field.top10[index],
+                 "Cashes": field.cashes[index], "ROI": field.roi[index]}
+            salary = sum(table.salary[lineup].tolist())
+            fpts_p = sum(table.fpts[lineup].tolist())
+            ceil_p = sum(table.ceiling[lineup].tolist())
+            own_p = list(table.ownership[lineup] / 100)
+            lu_names = table.names[lineup]
             lu_teams = []
             players_vs_def = 0
-            def_opps = []
-            for id in x["Lineup"]:
-                for k, v in self.player_dict.items():
-                    if v["ID"] == id:
-                        if 'DST' in v["Position"]:
-                            def_opps.append(v['Opp'])
-            for id in x["Lineup"]:
-                for k, v in self.player_dict.items():
-                    if v["ID"] == id:
-                        salary += v["Salary"]
-                        fpts_p += v["Fpts"]
-                        ceil_p += v["Ceiling"]
-                        own_p.append(v["Ownership"] / 100)
-                        lu_names.append(v["Name"])
-                        if 'DST' not in v["Position"]:
-                            lu_teams.append(v['Team'])
-                            if v['Team'] in def_opps:
-                                players_vs_def += 1
-                        continue
+            def_opps = [table.opponents[p] for p in lineup if 'DST' in table.positions[p]]
+            for p in lineup:
+                if 'DST' not in table.positions[p]:
+                    lu_teams.append(table.teams[p])
+                    if table.teams[p] in def_opps:
+                        players_vs_def += 1
             counter = collections.Counter(lu_teams)
             stacks = counter.most_common(2)
             own_p = np.prod(own_p)
@@ -1294,32 +2419,41 @@ class CFB_GPP_Simulator:
                         players_vs_def,
                         lu_type
                     )
+            if self.confidence_intervals is not None:
+                lineup_str += "".join(
+                    ",+/-{}%".format(round(half_width[index], 2)) for half_width in self.confidence_intervals.values()
+                )
             unique[index] = lineup_str
 
         out_path = os.path.join(
             os.path.dirname(__file__),
-            "../output/{}_gpp_sim_lineups_{}_{}.csv".format(
-                self.site, self.field_size, self.num_iterations
+            "../output/{}_gpp_sim_lineups_{}_{}{}.csv".format(
+                self.site, self.field_size, self.num_iterations, self.get_contest_suffix()
             ),
         )
+        # adaptive runs add the 95% confidence interval of each stat
+        ci_header = ""
+        if self.confidence_intervals is not None:
+            ci_names = {"win": "Win % CI", "top10": "Top 10% CI", "roi": "ROI% CI"}
+            ci_header = "".join("," + ci_names[name] for name in self.confidence_intervals)
         with open(out_path, "w") as f:
             if self.site == "dk":
                 if self.use_contest_data:
                     f.write(
-                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,ROI%,Proj. Own. Product,Avg. Return,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type\n"
+                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,ROI%,Proj. Own. Product,Avg. Return,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type" + ci_header + "\n"
                     )
                 else:
                     f.write(
-                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%, Proj. Own. Product,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type\n"
+                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%, Proj. Own. Product,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type" + ci_header + "\n"
                     )
             elif self.site == "fd":
                 if self.use_contest_data:
                     f.write(
-                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,ROI%,Proj. Own. Product,Avg. Return,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type\n"
+                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,ROI%,Proj. Own. Product,Avg. Return,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type" + ci_header + "\n"
                     )
                 else:
                     f.write(
-                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,Proj. Own. Product,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type\n"
+                        "QB,RB,RB,WR,WR,WR,FLEX,S-FLEX,Fpts Proj,Ceiling,Salary,Win %,Top 10%,Proj. Own. Product,Stack1 Type,Stack2 Type,Players vs DST,Lineup Type" + ci_header + "\n"
                     )
 
             for fpts, lineup_str in unique.items():
@@ -1327,46 +2461,39 @@ class CFB_GPP_Simulator:
 
         out_path = os.path.join(
             os.path.dirname(__file__),
-            "../output/{}_gpp_sim_player_exposure_{}_{}.csv".format(
-                self.site, self.field_size, self.num_iterations
+            "../output/{}_gpp_sim_player_exposure_{}_{}{}.csv".format(
+                self.site, self.field_size, self.num_iterations, self.get_contest_suffix()
             ),
         )
         with open(out_path, "w") as f:
             f.write("Player,Position,Team,Win%,Top10%,Sim. Own%,Proj. Own%,Avg. Return\n")
-            unique_players = {}
-            for val in self.field_lineups.values():
-                for player in val["Lineup"]:
-                    if player not in unique_players:
-                        unique_players[player] = {
-                            "Wins": val["Wins"],
-                            "Top10": val["Top10"],
-                            "In": 1,
-                            "ROI": val["ROI"],
-                        }
-                    else:
-                        unique_players[player]["Wins"] = (
-                                unique_players[player]["Wins"] + val["Wins"]
-                        )
-                        unique_players[player]["Top10"] = (
-                                unique_players[player]["Top10"] + val["Top10"]
-                        )
-                        unique_players[player]["In"] = unique_players[player]["In"] + 1
-                        unique_players[player]["ROI"] = (
-                                unique_players[player]["ROI"] + val["ROI"]
-                        )
-
-            for player, data in unique_players.items():
-                field_p = round(data["In"] / self.field_size * 100, 2)
-                win_p = round(data["Wins"] / self.num_iterations * 100, 2)
-                top10_p = round(data["Top10"] / self.num_iterations / 10 * 100, 2)
-                roi_p = round(data["ROI"] / data["In"] / self.num_iterations, 2)
-                for k, v in self.player_dict.items():
-                    if player == v["ID"]:
-                        proj_own = v["Ownership"]
-                        p_name = v["Name"]
-                        position = "/".join(v.get("Position"))
-                        team = v.get("Team")
-                        break
+            # sum lineup results up by player with the field's lineup matrix
+            lineups = self.field_lineups.lineups
+            num_slots = lineups.shape[1]
+            players_in = lineups.ravel()
+            on_slate = players_in >= 0
+            players_in = players_in[on_slate]
+            num_players = len(self.player_dict)
+            player_in = np.bincount(players_in, minlength=num_players)
+            player_wins = np.bincount(players_in, weights=np.repeat(self.field_lineups.wins, num_slots)[on_slate],
+                                      minlength=num_players)
+            player_top10 = np.bincount(players_in, weights=np.repeat(self.field_lineups.top10, num_slots)[on_slate],
+                                       minlength=num_players)
+            player_roi = np.bincount(players_in, weights=np.repeat(self.field_lineups.roi, num_slots)[on_slate],
+                                     minlength=num_players)
+            players = list(self.player_dict.values())
+            # players in the order they first show up in the field
+            unique_players, first_seen = np.unique(players_in, return_index=True)
+            for player in unique_players[np.argsort(first_seen)]:
+                field_p = round(player_in[player] / self.field_size * 100, 2)
+                win_p = round(player_wins[player] / self.num_iterations * 100, 2)
+                top10_p = round(player_top10[player] / self.num_iterations / 10 * 100, 2)
+                roi_p = round(player_roi[player] / player_in[player] / self.num_iterations, 2)
+                v = players[player]
+                proj_own = v["Ownership"]
+                p_name = v["Name"]
+                position = "/".join(v.get("Position"))
+                team = v.get("Team")
                 f.write(
                     "{},{},{},{}%,{}%,{}%,{}%,${}\n".format(
                         p_name.replace("#", "-"),
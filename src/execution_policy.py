@@ -0,0 +1,35 @@
+import os
+
+# settings that can be given as key=value anywhere on the command line, they override config.json
+execution_policy_keys = ['pool_backend', 'num_workers', 'pool_chunksize', 'blas_threads', 'pin_workers']
+
+# environment variables the common BLAS/OpenMP builds read for their thread count when they load
+blas_thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+
+def parse_execution_policy(arguments):
+    # splits key=value settings off the positional arguments
+    policy = {}
+    positional = []
+    for argument in arguments:
+        key, _, value = argument.partition('=')
+        if key not in execution_policy_keys or not value:
+            positional.append(argument)
+        elif key == 'pool_backend':
+            policy[key] = value
+        elif key == 'pin_workers':
+            policy[key] = value.lower() in ('1', 'true', 'yes')
+        else:
+            policy[key] = int(value)
+    return policy, positional
+
+
+def resolve_worker_threads(config):
+    # pool workers and BLAS threads inside every worker. 0 workers means one per core and 0 BLAS threads splits
+    # the cores evenly between the workers so they don't oversubscribe. kept free of numpy so main.py can call
+    # it before anything loads BLAS
+    cpu_count = os.cpu_count() or 1
+    num_workers = int(config.get('num_workers', 0)) or cpu_count
+    blas_threads = int(config.get('blas_threads', 0)) or max(1, cpu_count // num_workers)
+    return num_workers, blas_threads
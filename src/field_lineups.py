@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class FieldLineups:
+    # columnar store for the simulated contest field. every lineup is a row of player indices (positions in the
+    # simulator's player order, one column per roster slot in the order the field generator fills them) with
+    # parallel arrays for its type and sim results. field_lineups[i] still hands back the old dict shape
+    lineup_types = ['input', 'generated_stack', 'generated_nostack']
+    result_names = ['Wins', 'Top10', 'ROI', 'Cashes']
+
+    def __init__(self, player_ids, num_slots):
+        self.player_ids = np.array(player_ids)
+        self.player_index = {p: i for i, p in enumerate(player_ids)}
+        self.num_slots = num_slots
+        self.size = 0
+        # arrays are allocated with spare capacity so lineups can be added one at a time
+        self._lineups = np.full(shape=(0, num_slots), fill_value=-1, dtype=np.int32)
+        self._types = np.zeros(shape=0, dtype=np.int8)
+        self._results = np.zeros(shape=(len(self.result_names), 0))
+
+    def reserve(self, capacity):
+        if capacity <= len(self._types):
+            return
+        capacity = max(capacity, 2 * len(self._types))
+        lineups = np.full(shape=(capacity, self.num_slots), fill_value=-1, dtype=np.int32)
+        lineups[:self.size] = self._lineups[:self.size]
+        types = np.zeros(shape=capacity, dtype=np.int8)
+        types[:self.size] = self._types[:self.size]
+        results = np.zeros(shape=(len(self.result_names), capacity))
+        results[:, :self.size] = self._results[:, :self.size]
+        self._lineups, self._types, self._results = lineups, types, results
+
+    def append(self, lineups, types):
+        # lineups is (n, num_slots) player indices, types is a lineup type name or one type code per lineup
+        lineups = np.asarray(lineups, dtype=np.int32).reshape(-1, self.num_slots)
+        if isinstance(types, str):
+            types = self.lineup_types.index(types)
+        self.reserve(self.size + len(lineups))
+        self._lineups[self.size:self.size + len(lineups)] = lineups
+        self._types[self.size:self.size + len(lineups)] = types
+        self._results[:, self.size:self.size + len(lineups)] = 0
+        self.size += len(lineups)
+
+    def reset_results(self):
+        self._results[:, :self.size] = 0
+
+    @property
+    def lineups(self):
+        return self._lineups[:self.size]
+
+    @property
+    def types(self):
+        return self._types[:self.size]
+
+    @property
+    def wins(self):
+        return self._results[0, :self.size]
+
+    @wins.setter
+    def wins(self, value):
+        self._results[0, :self.size] = value
+
+    @property
+    def top10(self):
+        return self._results[1, :self.size]
+
+    @top10.setter
+    def top10(self, value):
+        self._results[1, :self.size] = value
+
+    @property
+    def roi(self):
+        return self._results[2, :self.size]
+
+    @roi.setter
+    def roi(self, value):
+        self._results[2, :self.size] = value
+
+    @property
+    def cashes(self):
+        return self._results[3, :self.size]
+
+    @cashes.setter
+    def cashes(self, value):
+        self._results[3, :self.size] = value
+
+    # dict style access, one lineup at a time
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __contains__(self, index):
+        return 0 <= index < self.size
+
+    def keys(self):
+        return range(self.size)
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        lineup = {"Lineup": [str(self.player_ids[p]) if p >= 0 else '' for p in self._lineups[index]]}
+        for name, value in zip(self.result_names, self._results[:, index]):
+            lineup[name] = value
+        lineup["Type"] = self.lineup_types[self._types[index]]
+        return lineup
+
+    def __setitem__(self, index, lineup):
+        # takes a lineup in the old dict shape, ids that aren't on the slate are stored as -1
+        if index > self.size:
+            raise KeyError(index)
+        if index == self.size:
+            self.append(np.full(self.num_slots, -1), lineup.get("Type", "input"))
+        self._lineups[index] = [self.player_index.get(str(p), -1) for p in lineup["Lineup"]]
+        self._types[index] = self.lineup_types.index(lineup.get("Type", "input"))
+        for i, name in enumerate(self.result_names):
+            self._results[i, index] = lineup.get(name, 0)
+
+    def values(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def items(self):
+        for index in range(self.size):
+            yield index, self[index]
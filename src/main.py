@@ -1,18 +1,63 @@
 import sys
-from cfb_gpp_simulator import *
-from windows_inhibitor import *
-from cfb_showdown_optimizer import *
-from cfb_optimizer import *
+from execution_policy import blas_thread_vars, parse_execution_policy, resolve_worker_threads
+
+# modules each process needs, imported only once that process is picked so a sim never pays for the optimizers
+process_modules = {
+    'opto': ['cfb_optimizer'],
+    'sd': ['cfb_showdown_optimizer'],
+    'sim': ['cfb_gpp_simulator'],
+}
+
+
+def benchmark_imports(repeats=5):
+    # cold import time of every process's modules and the heavy dependencies, each timed in a fresh interpreter
+    import os
+    import subprocess
+    modules = [m for process in process_modules.values() for m in process] + ['numpy', 'pandas', 'pulp',
+                                                                              'scipy.sparse']
+    for module in modules:
+        code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+        times = []
+        for _ in range(repeats):
+            result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                break
+            times.append(float(result.stdout.strip().splitlines()[-1]))
+        if len(times) < repeats:
+            print('{:<24} not available'.format(module))
+        else:
+            print('{:<24} {:8.1f} ms (best of {})'.format(module, min(times) * 1000, repeats))
+
+
+def set_blas_env(execution_policy):
+    # BLAS only reads its thread count from the environment when numpy first loads it, and forked pool workers
+    # inherit this process's BLAS, so the simulator's blas_threads setting has to be in place before anything
+    # imports numpy
+    import json
+    import os
+    with open(os.path.join(os.path.dirname(__file__), '../config.json'), encoding='utf-8-sig') as config_file:
+        config = json.load(config_file)
+    config.update(execution_policy)
+    _, blas_threads = resolve_worker_threads(config)
+    for var in blas_thread_vars:
+        os.environ[var] = str(blas_threads)
+
 
 def main(arguments):
-    if len(arguments) < 3 or len(arguments) > 7:
+    execution_policy, arguments = parse_execution_policy(arguments)
+    # the contests process takes any number of contest files
+    if len(arguments) < 3 or (len(arguments) > 7 and arguments[2] != 'contests'):
         print('Incorrect usage. Please see `README.md` for proper usage.')
         exit()
 
     site = arguments[1]
     process = arguments[2]
+    if process not in ('opto', 'sd', 'imports'):
+        set_blas_env(execution_policy)
 
     if process == 'opto':
+        from cfb_optimizer import CFB_Optimizer
         num_lineups = arguments[3]
         num_uniques = arguments[4]
         opto = CFB_Optimizer(site, num_lineups, num_uniques)
@@ -20,6 +65,7 @@ def main(arguments):
         opto.output()
 
     elif process == 'sd':
+        from cfb_showdown_optimizer import CFB_Showdown_Optimizer
         num_lineups = arguments[3]
         num_uniques = arguments[4]
         opto = CFB_Showdown_Optimizer(site, num_lineups, num_uniques)
@@ -27,6 +73,7 @@ def main(arguments):
         opto.output()
 
     elif process == 'sim':
+        from cfb_gpp_simulator import CFB_GPP_Simulator
         site = arguments[1]
         field_size = -1
         num_iterations = -1
@@ -46,11 +93,96 @@ def main(arguments):
         #if 'match' in arguments:
         #    match_lineup_input_to_field_size = True
         sim = CFB_GPP_Simulator(site, field_size, num_iterations, use_contest_data,
-                                use_file_upload)
-        sim.generate_field_lineups()
-        sim.run_tournament_simulation()
-        sim.output()
+                                use_file_upload, execution_policy)
+        try:
+            sim.generate_field_lineups()
+            sim.run_tournament_simulation()
+            sim.output()
+            if sim.sim_payouts is not None:
+                sim.output_portfolio(*sim.select_portfolio())
+        finally:
+            sim.close_pool()
+
+    elif process == 'update':
+        # python main.py <site> update <field_size or cid> <changes file in the site's data folder>
+        # re-runs the last incremental_sim run of this slate with late player news
+        import json
+        import os
+        from cfb_gpp_simulator import CFB_GPP_Simulator
+        use_contest_data = arguments[3] == 'cid'
+        field_size = -1 if use_contest_data else arguments[3]
+        changes_path = os.path.join(os.path.dirname(__file__), '../{}_data/{}'.format(site, arguments[4]))
+        with open(changes_path, encoding='utf-8-sig') as changes_file:
+            changes = json.load(changes_file)
+        sim = CFB_GPP_Simulator(site, field_size, 0, use_contest_data, False, execution_policy)
+        try:
+            if sim.load_sim_batches():
+                sim.update_players(changes)
+                sim.output()
+                if sim.sim_payouts is not None:
+                    sim.output_portfolio(*sim.select_portfolio())
+            else:
+                print('No saved simulation for this slate, run sim with incremental_sim turned on first')
+        finally:
+            sim.close_pool()
+
+    elif process == 'samplers':
+        # python main.py <site> samplers <field_size or cid> <num_iterations> [repeats]
+        from cfb_gpp_simulator import CFB_GPP_Simulator
+        use_contest_data = arguments[3] == 'cid'
+        field_size = -1 if use_contest_data else arguments[3]
+        sim = CFB_GPP_Simulator(site, field_size, arguments[4], use_contest_data, False, execution_policy)
+        try:
+            sim.generate_field_lineups()
+            sim.benchmark_samplers(int(arguments[5]) if len(arguments) > 5 else 10)
+        finally:
+            sim.close_pool()
+
+    elif process == 'scenarios':
+        # python main.py <site> scenarios <field_size or cid> <num_iterations> <scenario file in the site's data folder>
+        import json
+        import os
+        from cfb_gpp_simulator import CFB_GPP_Simulator
+        use_contest_data = arguments[3] == 'cid'
+        field_size = -1 if use_contest_data else arguments[3]
+        scenario_path = os.path.join(os.path.dirname(__file__), '../{}_data/{}'.format(site, arguments[5]))
+        with open(scenario_path, encoding='utf-8-sig') as scenario_file:
+            scenarios = json.load(scenario_file)
+        sim = CFB_GPP_Simulator(site, field_size, arguments[4], use_contest_data, False, execution_policy)
+        try:
+            sim.generate_field_lineups()
+            sim.run_scenarios(scenarios)
+        finally:
+            sim.close_pool()
+
+    elif process == 'entries':
+        # python main.py <site> entries <field_size or cid> <num_iterations> [entries file in the site's data folder]
+        from cfb_gpp_simulator import CFB_GPP_Simulator
+        use_contest_data = arguments[3] == 'cid'
+        field_size = -1 if use_contest_data else arguments[3]
+        sim = CFB_GPP_Simulator(site, field_size, arguments[4], use_contest_data, False, execution_policy)
+        try:
+            sim.load_entries(arguments[5] if len(arguments) > 5 else 'entries.csv')
+            sim.generate_field_lineups()
+            sim.output_entries(sim.evaluate_entries())
+        finally:
+            sim.close_pool()
+
+    elif process == 'contests':
+        # python main.py <site> contests <num_iterations> <contest file> [<contest file> ...], files in the site's data folder
+        import os
+        from cfb_gpp_simulator import CFB_GPP_Simulator
+        contest_paths = [os.path.join(os.path.dirname(__file__), '../{}_data/{}'.format(site, name))
+                         for name in arguments[4:]]
+        sim = CFB_GPP_Simulator(site, 0, arguments[3], False, False, execution_policy)
+        try:
+            sim.run_contests(contest_paths)
+        finally:
+            sim.close_pool()
+
+    elif process == 'imports':
+        benchmark_imports()
 
 
 if __name__ == "__main__":
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
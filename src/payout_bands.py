@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class PayoutBands:
+    # contest payouts as runs of places that pay the same amount, instead of one entry per place. band i pays
+    # amounts[i] to every place in [starts[i], ends[i]) (0 indexed, 0 is first place) and places outside every
+    # band pay nothing. everything handed back is net of the entry fee, so a place that doesn't cash is -entry_fee
+    def __init__(self, starts, ends, amounts, field_size, entry_fee):
+        starts = np.asarray(starts, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        self.starts = starts[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.amounts = np.asarray(amounts, dtype=float)[order]
+        if len(self.starts) == 0:
+            # a contest that pays nothing still needs one (empty) band to look places up in
+            self.starts, self.ends, self.amounts = np.zeros(1, np.int64), np.zeros(1, np.int64), np.zeros(1)
+        self.field_size = int(field_size)
+        self.entry_fee = float(entry_fee)
+        widths = self.ends - self.starts
+        # prize money paid out by all the bands before band i
+        self.band_totals = np.concatenate(([0.0], np.cumsum(self.amounts * widths)))[:-1]
+        # number of places that finish in the money
+        self.cash_line = int(np.sum(widths[self.amounts > 0]))
+        self.last_place_payout = float(self.payout(self.field_size - 1))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def prize_money(self, places):
+        # total prize money paid to the first `places` places, places can be an array of any shape
+        places = np.asarray(places)
+        band = np.searchsorted(self.starts, places, side="right") - 1
+        in_band = np.maximum(band, 0)
+        paid_places = np.clip(places - self.starts[in_band], 0, self.ends[in_band] - self.starts[in_band])
+        return np.where(band >= 0, self.band_totals[in_band] + self.amounts[in_band] * paid_places, 0.0)
+
+    def cumulative(self, places):
+        # net payout summed over the first `places` places
+        return self.prize_money(places) - self.entry_fee * np.asarray(places)
+
+    def payout(self, place):
+        # net payout of a single (0 indexed) place
+        return self.cumulative(np.asarray(place) + 1) - self.cumulative(place)
+
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class PlayerTable:
+    # struct of arrays view of the simulator's player_dict, row i is the i-th player in player_dict order.
+    # index maps a player ID to its row so lookups by ID don't have to scan player_dict
+    position_bits = {'QB': 1, 'RB': 2, 'WR': 4, 'FLEX': 8, 'S-FLEX': 16}
+
+    def __init__(self, player_dict):
+        players = list(player_dict.values())
+        self.size = len(players)
+        self.ids = np.array([str(p["ID"]) for p in players])
+        self.names = np.array([p["Name"] for p in players])
+        self.positions = [p["Position"] for p in players]
+        self.position_mask = np.array(
+            [sum(self.position_bits.get(pos, 0) for pos in p["Position"]) for p in players], dtype=np.int64
+        )
+        self.teams = np.array([p["Team"] for p in players])
+        self.opponents = np.array([p.get("Opp", '') for p in players])
+        self.team_names = sorted((set(self.teams) | set(self.opponents)) - {''})
+        team_lookup = {t: i for i, t in enumerate(self.team_names)}
+        self.team_codes = np.array([team_lookup.get(t, -1) for t in self.teams], dtype=np.int64)
+        self.opp_codes = np.array([team_lookup.get(t, -1) for t in self.opponents], dtype=np.int64)
+        self.matchups = [p.get("Matchup") for p in players]
+        self.salary = np.array([p["Salary"] for p in players])
+        self.fpts = np.array([p["Fpts"] for p in players], dtype=float)
+        self.stddev = np.array([p["StdDev"] for p in players], dtype=float)
+        self.ceiling = np.array([p["Ceiling"] for p in players], dtype=float)
+        self.ownership = np.array([p["Ownership"] for p in players], dtype=float)
+        self.index = {player_id: i for i, player_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return self.size
+
+    def has_position(self, pos):
+        # boolean mask of players eligible at pos
+        return (self.position_mask & self.position_bits[pos]) > 0
+
+    def rows(self, player_ids):
+        # rows for a list of player IDs, -1 for IDs that aren't on the slate
+        return np.array([self.index.get(str(p), -1) for p in player_ids], dtype=np.int64)